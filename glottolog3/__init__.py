@@ -60,6 +60,7 @@ def add_cors_headers_response_callback(event):
         'Access-Control-Allow-Origin': '*',
         'Access-Control-Allow-Methods': 'POST,GET,DELETE,PUT,OPTIONS',
         'Access-Control-Allow-Headers': 'Origin, Content-Type, Accept, Authorization',
+        'Access-Control-Expose-Headers': 'Link',
         'Access-Control-Allow-Credentials': 'true',
         'Access-Control-Max-Age': '1728000',
         })
@@ -99,6 +100,18 @@ def main(global_config, **settings):
     config.add_route(
         'glottolog.search',
         '/search')
+    config.add_route(
+        'glottolog.search_suggest',
+        '/search/suggest',
+        request_method='GET')
+    config.add_route(
+        'glottolog.search_batch',
+        '/search/batch',
+        request_method='POST')
+    config.add_route(
+        'glottolog.search_cache',
+        '/search/cache',
+        request_method='GET')
     config.add_route(
         'glottolog.get_identifier',
         '/identifier/{type}/{name}',
@@ -119,6 +132,50 @@ def main(global_config, **settings):
         'glottolog.get_languoid',
         '/languoid/{glottocode}',
         request_method='GET')
+    config.add_route(
+        'glottolog.get_languoids',
+        '/languoids',
+        request_method=('GET', 'POST'))
+    config.add_route(
+        'glottolog.get_descendants',
+        '/languoid/{glottocode}/descendants',
+        request_method='GET')
+    config.add_route(
+        'glottolog.get_tree',
+        '/languoid/{glottocode}/tree',
+        request_method='GET')
+    config.add_route(
+        'glottolog.get_newick',
+        '/languoid/{glottocode}/newick',
+        request_method='GET')
+    config.add_route(
+        'glottolog.map_layer',
+        '/languoid/{glottocode}/maplayer',
+        request_method='GET')
+    config.add_route(
+        'glottolog.language_tiles',
+        '/languages/tiles/{z}/{x}/{y}',
+        request_method='GET')
+    config.add_route(
+        'glottolog.bbox',
+        '/languoids/bbox',
+        request_method='GET')
+    config.add_route(
+        'glottolog.near',
+        '/languoids/near',
+        request_method='GET')
+    config.add_route(
+        'glottolog.get_lca',
+        '/languoid/{glottocode}/lca/{other}',
+        request_method='GET')
+    config.add_route(
+        'glottolog.lca_batch',
+        '/lca',
+        request_method='POST')
+    config.add_route(
+        'glottolog.classification',
+        '/classification',
+        request_method='POST')
     config.add_route(
         'glottolog.add_languoid',
         '/languoid',
@@ -139,6 +196,10 @@ def main(global_config, **settings):
         'glottolog.add_child',
         '/languoid/{glottocode}/child',
         request_method='POST')
+    config.add_route(
+        'glottolog.add_children',
+        '/languoid/{glottocode}/children',
+        request_method='POST')
 
     # UW blueprint code ends here
 
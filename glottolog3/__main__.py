@@ -271,6 +271,21 @@ def dbprime(args):
         initdb.prime(args)
 
 
+@command()
+def searchindex(args):
+    """
+    glottolog-app searchindex
+
+    Fill the normalized identifier names and create the indexes used by the search API
+    in an existing DB.
+    """
+    from glottolog3 import search
+
+    with_session(args)
+    with transaction.manager:
+        search.create_indexes()
+
+
 @command()
 def dbinit(args):
     """
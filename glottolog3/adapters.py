@@ -1,13 +1,14 @@
 from __future__ import unicode_literals
 
 import datetime
-import xml.etree.ElementTree as et
 from itertools import cycle
-import tempfile
+from xml.sax.saxutils import escape
 
 import sqlalchemy as sa
 import sqlalchemy.orm
-from pyramid.httpexceptions import HTTPFound
+from sqlalchemy.dialects.postgresql import array
+from pyramid.httpexceptions import HTTPFound, HTTPBadRequest
+from pyramid.response import Response
 
 from clld.interfaces import IDataset, IMetadata, ILanguage, IIndex
 from clld.web.adapters.base import Representation, Index
@@ -19,8 +20,11 @@ from clld.db.models.common import Language, LanguageIdentifier, Identifier
 from clld.web.icon import ORDERED_ICONS
 from clld.lib import bibtex
 
-from glottolog3.models import Languoid, LanguoidLevel, Languoidcountry, Country
+from glottolog3.models import (
+    Languoid, LanguoidLevel, Languoidcountry, Country,
+)
 from glottolog3.interfaces import IProvider
+from glottolog3 import tree
 
 
 class BibTexCitation(BibTex):
@@ -112,7 +116,10 @@ class Treeview(Representation):
 
 
 class Newick(Representation):
-    """Classification tree represented in Newick format.
+    """Classification tree rooted at the current languoid represented in Newick format.
+
+    The tree can be limited with the request parameters `depth` and `level` (see
+    `glottolog3.tree.newick_options`).
     """
     name = 'Newick format'
     mimetype = 'text/vnd.clld.newick+plain'
@@ -120,9 +127,11 @@ class Newick(Representation):
     extension = 'newick.txt'
 
     def render(self, languoid, request):
-        if languoid.family:
-            languoid = languoid.family
-        return languoid.newick
+        try:
+            options = tree.newick_options(request.params)
+        except ValueError as e:
+            raise HTTPBadRequest('{0}'.format(e))
+        return tree.get_newick(languoid, session=request.db, **options)
 
 
 class PhyloXML(Representation):
@@ -133,50 +142,99 @@ class PhyloXML(Representation):
     send_mimetype = 'application/xml'
     extension = 'phylo.xml'
     namespace = 'http://www.phyloxml.org'
+    # number of clades serialized per chunk of the response body.
+    chunksize = 500
+
+    def render_to_response(self, ctx, req):
+        res = Response(app_iter=self.stream(ctx, req))
+        res.vary = str('Accept')
+        res.content_type = str(self.send_mimetype)
+        res.charset = str('utf-8')
+        return res
 
     def render(self, root, req):
-        self.depth_limit = 2 if root.child_language_count > 350 else 100
-        et.register_namespace('', self.namespace)
-        e = self.element('phyloxml')
-        phylogeny = self.element('phylogeny', rooted="true")
-        phylogeny.append(self.element('name', root.name))
-        phylogeny.append(self.element('description', root.name))
-        clade = self.clade(root, req)
-        self.append_children(clade, root, req, 0)
-        phylogeny.append(clade)
-        e.append(phylogeny)
-        tree = et.ElementTree(element=e)
-        with tempfile.TemporaryFile() as fp:
-            tree.write(fp, encoding='utf8', xml_declaration=True)
-            fp.seek(0)
-            return fp.read()
-
-    def element(self, name, text=None, **kw):
-        e = et.Element('{%s}%s' % (self.namespace, name), **kw)
-        if text:
-            e.text = text
-        return e
-
-    def clade(self, lang, req, level=0):
-        e = self.element('clade', branch_length="0.2")
-        if lang.level == LanguoidLevel.language or level == self.depth_limit:
-            e.append(self.element('name', lang.name))
-            ann = self.element('annotation')
-            ann.append(self.element('desc', ' > '.join(reversed([l.name for l in lang.get_ancestors()]))))
-            ann.append(self.element('uri', req.resource_url(lang)))
-            e.append(ann)
-        return e
-
-    def append_children(self, clade, lang, req, level):
-        if level > self.depth_limit:
-            return
-        children = [l for l in lang.children if
-                    l.level in [LanguoidLevel.language, LanguoidLevel.family]]
-        for child in sorted(children, key=lambda l: l.name):
-            subclade = self.clade(child, req, level)
-            if child.children:
-                self.append_children(subclade, child, req, level + 1)
-            clade.append(subclade)
+        return b''.join(self.stream(root, req))
+
+    def stream(self, root, req):
+        """
+        Serialize the tree in chunks, in depth-first order with siblings ordered by name.
+
+        The subtree is read with one query, and the lineage annotation of each clade is
+        derived from the stack of open clades. Since the iterator may be consumed after
+        the request transaction has ended, all data of the root is read up front and the
+        subtree is read with a session of its own.
+        """
+        lineage = [l['name'] for l in root.get_classification_path()]
+        return self._chunks(
+            req.db.get_bind(), root.pk, root.id, root.name, root.level, lineage,
+            req.route_url)
+
+    @staticmethod
+    def subtree(session, pk):
+        """
+        :return: Query selecting (pk, father_pk, id, name, level) of the descendants of a \
+        languoid - but dialects - in depth-first order with siblings ordered by name.
+        """
+        # the descendants are ordered by the (name, id) pairs of their path from the root:
+        top = session.query(
+            Languoid.pk, Languoid.father_pk, Languoid.id, Languoid.name, Languoid.level,
+            array([Languoid.name, Languoid.id]).label('path'))\
+            .filter(Languoid.father_pk == pk)\
+            .filter(Languoid.level != LanguoidLevel.dialect)\
+            .cte('subtree', recursive=True)
+        child = sa.orm.aliased(Languoid)
+        subtree = top.union_all(session.query(
+            child.pk, child.father_pk, child.id, child.name, child.level,
+            top.c.path.op('||')(array([child.name, child.id])))
+            .filter(child.father_pk == top.c.pk)
+            .filter(child.level != LanguoidLevel.dialect))
+        return session.query(
+            subtree.c.pk, subtree.c.father_pk, subtree.c.id, subtree.c.name,
+            subtree.c.level)\
+            .order_by(subtree.c.path)
+
+    def _chunks(self, bind, pk, id_, name, level, lineage, route_url):
+        # the session is opened only once the response is consumed:
+        session = None
+        try:
+            session = sa.orm.Session(bind=bind)
+            query = self.subtree(session, pk).execution_options(stream_results=True)
+            chunk = [
+                "<?xml version='1.0' encoding='utf8'?>\n",
+                '<phyloxml xmlns="{0}"><phylogeny rooted="true">'.format(self.namespace),
+                '<name>{0}</name><description>{0}</description>'.format(escape(name)),
+                self.clade(id_, name, level, lineage, route_url),
+            ]
+            # the open clades as (pk, name) pairs:
+            stack = [(pk, name)]
+            for i, (pk, father_pk, id_, name, level) in enumerate(query.yield_per(1000)):
+                while stack[-1][0] != father_pk:
+                    stack.pop()
+                    chunk.append('</clade>')
+                chunk.append(self.clade(
+                    id_, name, level, lineage + [n for _, n in stack], route_url))
+                stack.append((pk, name))
+                if (i + 1) % self.chunksize == 0:
+                    yield ''.join(chunk).encode('utf8')
+                    chunk = []
+            chunk.extend('</clade>' for _ in stack)
+            chunk.append('</phylogeny></phyloxml>')
+            yield ''.join(chunk).encode('utf8')
+        finally:
+            if session is not None:
+                session.close()
+
+    def clade(self, id_, name, level, lineage, route_url):
+        """
+        :return: The opening tag of the clade for a languoid, annotated for languages.
+        """
+        if level != LanguoidLevel.language:
+            return '<clade branch_length="0.2">'
+        return '<clade branch_length="0.2"><name>{0}</name><annotation>' \
+            '<desc>{1}</desc><uri>{2}</uri></annotation>'.format(
+                escape(name),
+                escape(' > '.join(lineage)),
+                escape(route_url('language', id=id_)))
 
 
 class GlottologGeoJsonLanguages(GeoJsonLanguages):
@@ -0,0 +1,197 @@
+"""
+Per-process caching of derived data.
+
+Each web worker holds its own caches. To keep them coherent across workers, cached values
+are tagged with a generation counter which is stored in the database and bumped by every
+write which affects the cached data; a cache seeing a new generation drops all entries.
+Other workers see a new generation within the check interval of their caches, the worker
+which committed the write right away.
+"""
+from __future__ import unicode_literals
+import time
+import threading
+from collections import OrderedDict
+
+import transaction
+from clld.db.meta import DBSession
+from clld.db.models.common import Config
+
+#: Generation of the data searchable via the search API, i.e. identifiers and languoids.
+SEARCH = 'search'
+#: Generation of the classification tree, i.e. fathers, names, levels and status of languoids.
+TREE = 'tree'
+#: Generation of the data shown on maps, i.e. coordinates and families of languoids.
+GEO = 'geo'
+
+
+# Generation and DerivedData instances of this process.
+_WATCHERS = []
+
+
+def _generation_key(name):
+    return '__generation_{0}__'.format(name)
+
+
+def get_generation(name, session=None):
+    session = session or DBSession
+    value = session.query(Config.value)\
+        .filter(Config.key == _generation_key(name))\
+        .scalar()
+    return int(value) if value else 0
+
+
+def bump_generation(name, session=None):
+    """
+    Increment a generation counter within the current transaction.
+    """
+    session = session or DBSession
+    cfg = session.query(Config)\
+        .filter(Config.key == _generation_key(name))\
+        .with_for_update()\
+        .first()
+    if cfg:
+        cfg.value = '{0}'.format(int(cfg.value) + 1)
+    else:
+        session.add(Config(key=_generation_key(name), value='1'))
+    transaction.get().addAfterCommitHook(_after_commit, args=(name,))
+
+
+def _after_commit(success, name):
+    if success:
+        invalidate(name)
+
+
+def invalidate(name):
+    """
+    Make the caches of this process depending on a generation check it on next access.
+    """
+    for watcher in _WATCHERS:
+        if watcher.name == name:
+            watcher.invalidate()
+
+
+class Generation(object):
+    """
+    The value of a generation counter, read from the database at most every
+    `check_interval` seconds.
+    """
+    def __init__(self, name, check_interval=5, clock=time.time):
+        self.name = name
+        self.check_interval = check_interval
+        self.clock = clock
+        self.value = None
+        self._next_check = 0
+        self._lock = threading.Lock()
+        _WATCHERS.append(self)
+
+    def invalidate(self):
+        with self._lock:
+            self._next_check = 0
+
+    def get(self, session=None):
+        with self._lock:
+            if self.clock() >= self._next_check:
+                self.value = get_generation(self.name, session=session)
+                self._next_check = self.clock() + self.check_interval
+            return self.value
+
+
+class DerivedData(object):
+    """
+    A value computed from the database, rebuilt when the generation it depends on changes.
+
+    To keep lookups cheap, the generation is checked at most every `check_interval`
+    seconds.
+    """
+    def __init__(self, factory, generation, check_interval=5, clock=time.time):
+        self.factory = factory
+        self.name = generation
+        self.check_interval = check_interval
+        self.clock = clock
+        self.generation = None
+        self.value = None
+        self._next_check = 0
+        self._lock = threading.Lock()
+        _WATCHERS.append(self)
+
+    def invalidate(self):
+        with self._lock:
+            self._next_check = 0
+
+    def get(self, session=None):
+        return self.get_versioned(session=session)[0]
+
+    def get_versioned(self, session=None):
+        """
+        :return: pair (value, generation the value was computed for).
+        """
+        with self._lock:
+            if self.clock() >= self._next_check:
+                generation = get_generation(self.name, session=session)
+                if self.value is None or generation != self.generation:
+                    self.value = self.factory(session or DBSession)
+                    self.generation = generation
+                self._next_check = self.clock() + self.check_interval
+            return self.value, self.generation
+
+
+class LRUCache(object):
+    """
+    A thread-safe mapping with bounded size, time-to-live for entries and invalidation by
+    generation.
+    """
+    def __init__(self, maxsize=1000, ttl=300, clock=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _sync(self, generation):
+        if generation != self.generation:
+            self.evictions += len(self._items)
+            self._items.clear()
+            self.generation = generation
+
+    def get(self, key, generation=None):
+        """
+        :return: The cached value or None.
+        """
+        with self._lock:
+            self._sync(generation)
+            item = self._items.pop(key, None)
+            if item is not None:
+                if item[0] > self.clock():
+                    # re-insert to mark as most recently used.
+                    self._items[key] = item
+                    self.hits += 1
+                    return item[1]
+                self.evictions += 1
+            self.misses += 1
+
+    def set(self, key, value, generation=None):
+        with self._lock:
+            self._sync(generation)
+            self._items.pop(key, None)
+            self._items[key] = (self.clock() + self.ttl, value)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def __len__(self):
+        return len(self._items)
+
+    def stats(self):
+        return {
+            'size': len(self),
+            'maxsize': self.maxsize,
+            'ttl': self.ttl,
+            'generation': self.generation,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
@@ -12,7 +12,7 @@ from clld.web.datatables.source import Sources
 from clld.web.util.helpers import icon
 
 from glottolog3.models import (
-    Macroarea, Languoid, TreeClosureTable,
+    Macroarea, Languoid, in_subtree,
     LanguoidLevel, LanguoidStatus, Provider, Refprovider, Doctype, Ref,
 )
 from glottolog3.util import getRefs, get_params, languoid_link, format_ca_icon
@@ -344,9 +344,8 @@ class Refs(Sources):
         if self.language:
             subquery = DBSession.query(LanguageSource)\
                 .filter_by(source_pk=Ref.pk)\
-                .join(TreeClosureTable,
-                      TreeClosureTable.child_pk == LanguageSource.language_pk)\
-                .filter(TreeClosureTable.parent_pk == self.language.pk)
+                .join(Languoid, Languoid.pk == LanguageSource.language_pk)\
+                .filter(in_subtree(Languoid, self.language))
             query = query.filter(subquery.exists())
         elif self.complexquery:
             query = getRefs(self.complexquery[0])
@@ -0,0 +1,250 @@
+"""
+Spatial indexes of the geocoded languoids.
+
+`TileGrid` serves the tiles of the languages map.
+
+Points are addressed by the Morton code of their Web Mercator pixel at zoom level `ZOOM`,
+i.e. by interleaving the bits of the x and y pixel coordinates. All points of a map tile
+- and of any square cell within a tile - share a prefix of their codes, so with the points
+sorted by code, the points of a tile are a contiguous range found by binary search.
+Prefix sums of the coordinates give the centroid of any range in constant time, which
+places the markers of clusters.
+
+`SpatialIndex` answers bounding box and nearest neighbour queries. Languoids are sorted by
+longitude for bounding boxes, and held in a k-d tree over points on the unit sphere for
+nearest neighbours: the straight-line distance between such points grows with the
+great-circle distance, so there are no special cases at the antimeridian or the poles.
+"""
+from __future__ import unicode_literals
+import math
+import heapq
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+
+import sqlalchemy as sa
+import sqlalchemy.orm
+from clld.db.models.common import Language
+
+from glottolog3.models import Languoid, LanguoidLevel
+
+# Zoom level of the pixel coordinates of points; 2 ** 24 pixels span about 2cm each.
+ZOOM = 24
+# Maximal latitude covered by Web Mercator tiles.
+MAX_LATITUDE = 85.0511287798
+# Tiles of lower zoom levels cluster the points of each cell of 4 ** CELL_ZOOM cells.
+CLUSTER_MAX_ZOOM = 7
+CELL_ZOOM = 2
+# Mean radius of the earth in km.
+EARTH_RADIUS = 6371.0088
+
+GeoLanguage = namedtuple(
+    'GeoLanguage', 'pk id name longitude latitude family_pk family_id family_name')
+Cluster = namedtuple('Cluster', 'count longitude latitude')
+GeoLanguoid = namedtuple('GeoLanguoid', 'pk id name longitude latitude level')
+
+
+def pixel(longitude, latitude, zoom=ZOOM):
+    """
+    :return: (x, y) pixel coordinates of a point at a zoom level, i.e. coordinates of the \
+    tile containing the point.
+    """
+    n = 2 ** zoom
+    lat = max(-MAX_LATITUDE, min(MAX_LATITUDE, latitude))
+    sin = math.sin(math.radians(lat))
+    x = (longitude + 180.0) / 360.0
+    y = 0.5 - math.log((1 + sin) / (1 - sin)) / (4 * math.pi)
+    return max(0, min(int(x * n), n - 1)), max(0, min(int(y * n), n - 1))
+
+
+def _spread(v):
+    # inserts a zero bit before each of the lower 32 bits of v.
+    v = (v | (v << 16)) & 0x0000FFFF0000FFFF
+    v = (v | (v << 8)) & 0x00FF00FF00FF00FF
+    v = (v | (v << 4)) & 0x0F0F0F0F0F0F0F0F
+    v = (v | (v << 2)) & 0x3333333333333333
+    return (v | (v << 1)) & 0x5555555555555555
+
+
+def morton(x, y):
+    return (_spread(y) << 1) | _spread(x)
+
+
+def code_range(z, x, y):
+    """
+    :return: (lo, hi) such that the points in tile (z, x, y) have codes lo <= c < hi.
+    """
+    shift = ZOOM - z
+    lo = morton(x << shift, y << shift)
+    return lo, lo + 4 ** shift
+
+
+class TileGrid(object):
+    """
+    The geocoded languages sorted by Morton code.
+    """
+    def __init__(self, items):
+        """
+        :param items: Iterable of GeoLanguage tuples.
+        """
+        points = sorted(
+            (morton(*pixel(item.longitude, item.latitude)), GeoLanguage(*item))
+            for item in items)
+        self.codes = [code for code, _ in points]
+        self.languages = [language for _, language in points]
+        self._lon_sums, self._lat_sums = array('d', [0]), array('d', [0])
+        for language in self.languages:
+            self._lon_sums.append(self._lon_sums[-1] + language.longitude)
+            self._lat_sums.append(self._lat_sums[-1] + language.latitude)
+
+    @classmethod
+    def from_db(cls, session):
+        Family = sa.orm.aliased(Languoid, flat=True)
+        return cls(session.query(
+            Languoid.pk,
+            Languoid.id,
+            Languoid.name,
+            Languoid.longitude,
+            Languoid.latitude,
+            Languoid.family_pk,
+            Family.id,
+            Family.name)
+            .outerjoin(Family, Family.pk == Languoid.family_pk)
+            .filter(Language.active)
+            .filter(Languoid.level == LanguoidLevel.language)
+            .filter(Languoid.latitude != None)
+            .filter(Languoid.longitude != None))
+
+    def __len__(self):
+        return len(self.codes)
+
+    def cluster(self, i, j):
+        n = j - i
+        return Cluster(
+            n,
+            (self._lon_sums[j] - self._lon_sums[i]) / n,
+            (self._lat_sums[j] - self._lat_sums[i]) / n)
+
+    def tile(self, z, x, y):
+        """
+        :return: list of GeoLanguage and Cluster tuples in tile (z, x, y). Below zoom \
+        level `CLUSTER_MAX_ZOOM`, cells holding more than one language are represented \
+        by a cluster.
+
+        x is taken modulo the number of tiles per row, to support maps wrapping around.
+        """
+        if not 0 <= z <= ZOOM or not 0 <= y < 2 ** z:
+            raise ValueError('invalid tile {0}/{1}/{2}'.format(z, x, y))
+        lo, hi = code_range(z, x % 2 ** z, y)
+        i = bisect_left(self.codes, lo)
+        end = bisect_left(self.codes, hi, i)
+        if z >= CLUSTER_MAX_ZOOM:
+            return self.languages[i:end]
+
+        res, step = [], 4 ** (ZOOM - z - CELL_ZOOM)
+        while i < end:
+            # the points of the cell of the point at i:
+            j = bisect_left(self.codes, (self.codes[i] // step + 1) * step, i, end)
+            res.append(self.cluster(i, j) if j - i > 1 else self.languages[i])
+            i = j
+        return res
+
+
+def unit_vector(longitude, latitude):
+    lon, lat = math.radians(longitude), math.radians(latitude)
+    return math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat)
+
+
+class SpatialIndex(object):
+    """
+    The geocoded languoids, for bounding box and nearest neighbour queries.
+    """
+    def __init__(self, items):
+        """
+        :param items: Iterable of GeoLanguoid tuples.
+        """
+        self.languoids = sorted((GeoLanguoid(*item) for item in items),
+                                key=lambda l: (l.longitude, l.pk))
+        self.longitudes = [l.longitude for l in self.languoids]
+
+        # The k-d tree is stored implicitly: the node of range [lo, hi) of the points is
+        # the median at (lo + hi) // 2, splitting the points sorted along axis
+        # depth % 3 into the ranges of its children.
+        points = [unit_vector(l.longitude, l.latitude) for l in self.languoids]
+        order = list(range(len(points)))
+        ranges = [(0, len(points), 0)]
+        while ranges:
+            lo, hi, depth = ranges.pop()
+            if hi - lo > 1:
+                axis = depth % 3
+                order[lo:hi] = sorted(order[lo:hi], key=lambda i: points[i][axis])
+                mid = (lo + hi) // 2
+                ranges.extend([(lo, mid, depth + 1), (mid + 1, hi, depth + 1)])
+        self.nodes = [self.languoids[i] for i in order]
+        self.coords = [array('d', [points[i][axis] for i in order]) for axis in range(3)]
+
+    @classmethod
+    def from_db(cls, session):
+        return cls(session.query(
+            Languoid.pk,
+            Languoid.id,
+            Languoid.name,
+            Languoid.longitude,
+            Languoid.latitude,
+            Languoid.level)
+            .filter(Language.active)
+            .filter(Languoid.latitude != None)
+            .filter(Languoid.longitude != None))
+
+    def __len__(self):
+        return len(self.languoids)
+
+    def bbox(self, west, south, east, north, levels=None):
+        """
+        :param levels: Collection of LanguoidLevel to include or None for all levels.
+        :return: Generator of the GeoLanguoid tuples within the box, ordered by longitude \
+        from west to east. Boxes with west > east span the antimeridian.
+        """
+        ranges = [(west, east)] if west <= east else [(west, 180), (-180, east)]
+        for w, e in ranges:
+            i = bisect_left(self.longitudes, w)
+            j = bisect_right(self.longitudes, e, i)
+            for languoid in self.languoids[i:j]:
+                if south <= languoid.latitude <= north \
+                        and (levels is None or languoid.level in levels):
+                    yield languoid
+
+    def near(self, longitude, latitude, k, levels=None):
+        """
+        :param levels: Collection of LanguoidLevel to include or None for all levels.
+        :return: list of the k nearest (GeoLanguoid, distance in km) pairs, nearest first.
+        """
+        query = unit_vector(longitude, latitude)
+        # max-heap of the k nearest points found, as (-squared distance, index) pairs.
+        heap = []
+
+        def search(lo, hi, depth):
+            if lo >= hi:
+                return
+            mid = (lo + hi) // 2
+            d2 = sum((query[a] - self.coords[a][mid]) ** 2 for a in range(3))
+            if levels is None or self.nodes[mid].level in levels:
+                if len(heap) < k:
+                    heapq.heappush(heap, (-d2, mid))
+                elif d2 < -heap[0][0]:
+                    heapq.heapreplace(heap, (-d2, mid))
+            diff = query[depth % 3] - self.coords[depth % 3][mid]
+            if diff < 0:
+                near, far = (lo, mid), (mid + 1, hi)
+            else:
+                near, far = (mid + 1, hi), (lo, mid)
+            search(near[0], near[1], depth + 1)
+            # points beyond the splitting plane are at least |diff| away.
+            if len(heap) < k or diff * diff < -heap[0][0]:
+                search(far[0], far[1], depth + 1)
+
+        if k > 0:
+            search(0, len(self.nodes), 0)
+        return [
+            (self.nodes[i], 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(-d2) / 2)))
+            for d2, i in sorted(heap, reverse=True)]
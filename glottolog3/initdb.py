@@ -17,7 +17,12 @@ from pyglottolog.references import BibFile
 from pyglottolog.languoids import Macroarea
 
 from glottolog3 import models
-from glottolog3.scripts.util import recreate_treeclosure, compute_pages
+from glottolog3 import search
+from glottolog3 import tree
+from glottolog3.scripts.util import (
+    recreate_treeclosure, recreate_intervals, recreate_lineages, recreate_map_layers,
+    compute_pages,
+)
 
 PREF_YEAR_PATTERN = re.compile('\[(?P<year>(1|2)[0-9]{3})(\-[0-9]+)?\]')
 YEAR_PATTERN = re.compile('(?P<year>(1|2)[0-9]{3})')
@@ -160,6 +165,10 @@ def prime(args):
     it will have to be run periodically whenever data has been updated.
     """
     recreate_treeclosure()
+    recreate_intervals()
+    recreate_lineages()
+    recreate_map_layers()
+    search.create_indexes()
 
     for lpk, mas in DBSession.execute("""\
 select
@@ -229,6 +238,10 @@ group by l.pk"""):
                         DBSession.add(
                             common.ValueSetReference(source_pk=spk, valueset_pk=vspk))
 
+    # The classification tree is final now, so the snapshot for the web app is written.
+    DBSession.flush()
+    tree.write()
+
 
 def add_identifier(languoid, data, name, type, description, lang='en'):
     if len(lang) > 3:
@@ -245,6 +258,7 @@ def add_identifier(languoid, data, name, type, description, lang='en'):
             type=type,
             description=description,
             lang=lang)
+        search.index_identifier(identifier)
     DBSession.add(common.LanguageIdentifier(language=languoid, identifier=identifier))
 
 
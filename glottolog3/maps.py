@@ -1,8 +1,9 @@
+import sqlalchemy as sa
 from clld.web.maps import Map, Layer, Legend
 from clld.web.adapters.geojson import GeoJson
 from clld.web.util.htmllib import HTML, literal
 
-from glottolog3.models import LanguoidLevel
+from glottolog3.models import Languoid, LanguoidLevel, MapLayer
 
 
 class Language(object):
@@ -18,14 +19,20 @@ class Language(object):
 
 
 class LanguoidGeoJson(GeoJson):
-    def __init__(self, obj, icon_map=None):
+    def __init__(self, obj, icon_map=None, geocoords=None):
+        """
+        :param geocoords: Rows of `Languoid.get_geocoords`, if known, e.g. from a MapLayer.
+        """
         super(LanguoidGeoJson, self).__init__(obj)
         self.icon_map = icon_map or {}
+        self.geocoords = geocoords
 
     def feature_iterator(self, ctx, req):
         res = [(ctx.pk, ctx.name, ctx.longitude, ctx.latitude, ctx.id)] \
             if ctx.latitude else []
-        return res + list(ctx.get_geocoords())
+        if self.geocoords is None:
+            return res + list(ctx.get_geocoords())
+        return res + list(self.geocoords)
 
     def featurecollection_properties(self, ctx, req):
         return {'layer': getattr(ctx, 'id', '')}
@@ -45,11 +52,20 @@ class LanguoidMap(Map):
         self.icon_map = icon_map or {}
 
     def get_layers(self):
-        yield Layer(
-            self.ctx.id,
-            self.ctx.name,
-            LanguoidGeoJson(
-                self.ctx, self.icon_map).render(self.ctx, self.req, dump=False))
+        layer_hash, has_children = self.req.db.query(
+            sa.select([MapLayer.hash])
+            .where(MapLayer.languoid_pk == self.ctx.pk)
+            .as_scalar(),
+            sa.exists().where(Languoid.father_pk == self.ctx.pk)).one()
+        if layer_hash:
+            # precomputed layers are loaded - and cached - by the browser.
+            data = self.req.route_url(
+                'glottolog.map_layer', glottocode=self.ctx.id, _query={'v': layer_hash})
+        else:
+            data = LanguoidGeoJson(
+                self.ctx, self.icon_map, geocoords=None if has_children else []
+            ).render(self.ctx, self.req, dump=False)
+        yield Layer(self.ctx.id, self.ctx.name, data)
 
     def get_options(self):
         res = {'max_zoom': 12}
@@ -3,6 +3,7 @@
 Project related model.
 """
 from string import capwords
+from collections import namedtuple
 import re
 
 from zope.interface import implementer
@@ -19,18 +20,18 @@ from sqlalchemy import (
     desc,
     UniqueConstraint,
     and_,
-    cast,
-    Text,
     Index,
+    tuple_,
 )
-from sqlalchemy.orm import relationship, backref
-from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.orm import relationship, backref, aliased, joinedload
+from sqlalchemy.dialects.postgresql import TSVECTOR, JSONB, aggregate_order_by
 from sqlalchemy.sql.expression import func
 
 from clld.interfaces import ISource, ILanguage
 from clld.db.meta import DBSession, Base, CustomModelMixin
 from clld.db.models.common import (
-    Language, Source, HasSourceMixin, IdNameDescriptionMixin, IdentifierType, Identifier, LanguageIdentifier
+    Language, Source, HasSourceMixin, IdNameDescriptionMixin, IdentifierType, Identifier, LanguageIdentifier,
+    ValueSet, Parameter,
 )
 from clld.util import DeclEnum
 from clldutils.misc import slug
@@ -224,6 +225,9 @@ SPECIAL_FAMILIES = (
 BOOKKEEPING = u'Bookkeeping'
 
 
+Ancestor = namedtuple('Ancestor', 'pk id name level')
+
+
 @implementer(ILanguage)
 class Languoid(CustomModelMixin, Language):
     """
@@ -254,6 +258,14 @@ class Languoid(CustomModelMixin, Language):
     child_language_count = Column(Integer)
     child_dialect_count = Column(Integer)
 
+    # Nested set interval of the languoid within the tree of its top-level family, i.e.
+    # the descendants of a languoid are the members of its family with lft in (lft, rgt].
+    lft = Column(Integer)
+    rgt = Column(Integer)
+
+    # Ids and names of the ancestors, top-level family first, as list of objects.
+    lineage = Column(JSONB)
+
     descendants = relationship(
         'Languoid',
         order_by='Languoid.name, Languoid.id',
@@ -291,28 +303,100 @@ class Languoid(CustomModelMixin, Language):
         # retrieve the ancestors ordered by distance, i.e. from direct parent
         # to top-level family:
         return session.query(Languoid)\
-            .join(TreeClosureTable, and_(
-                TreeClosureTable.parent_pk == Languoid.pk,
-                TreeClosureTable.depth > 0))\
-            .filter(TreeClosureTable.child_pk == self.pk)\
-            .order_by(TreeClosureTable.depth)
+            .filter(in_subtree(self, Languoid, proper=True))\
+            .order_by(Languoid.lft.desc())
+
+    def get_lineage(self, session=None):
+        """
+        :return: List of `Ancestor` tuples for the ancestors of self, from the father to the \
+        top-level family.
+
+        .. note::
+
+            The ancestors are looked up in the shared tree snapshot if it is up to date,
+            without querying the database.
+        """
+        from glottolog3.tree import get_snapshot
+
+        session = session or DBSession
+        snapshot = get_snapshot(session=session)
+        i = snapshot.index(self.pk) if snapshot else None
+        if i is not None:
+            return snapshot.lineage(i)
+        return [Ancestor(*row) for row in session.query(
+            Languoid.pk, Languoid.id, Languoid.name, Languoid.level)
+            .filter(in_subtree(self, Languoid, proper=True))
+            .order_by(Languoid.lft.desc())]
+
+    @staticmethod
+    def get_lineages(glottocodes, session=None):
+        """
+        Lineages of many languoids at once, see `get_lineage`.
+
+        :return: dict mapping the glottocodes of active languoids to lists of `Ancestor` \
+        tuples.
+        """
+        from glottolog3.tree import get_snapshot
+
+        session = session or DBSession
+        glottocodes = list(glottocodes)
+        snapshot = get_snapshot(session=session)
+        if snapshot is not None:
+            res = {}
+            for gc, pk in session.query(Languoid.id, Languoid.pk)\
+                    .filter(Languoid.id.in_(glottocodes))\
+                    .filter(Language.active == True):
+                i = snapshot.index(pk)
+                if i is None:
+                    # added after the snapshot was written.
+                    break
+                res[gc] = snapshot.lineage(i)
+            else:
+                return res
+
+        res = {}
+        ancestor = aliased(Languoid, flat=True)
+        for gc, pk, id_, name, level in session.query(
+                Languoid.id, ancestor.pk, ancestor.id, ancestor.name, ancestor.level)\
+                .outerjoin(TreeClosureTable, and_(
+                    TreeClosureTable.child_pk == Languoid.pk, TreeClosureTable.depth > 0))\
+                .outerjoin(ancestor, ancestor.pk == TreeClosureTable.parent_pk)\
+                .filter(Languoid.id.in_(glottocodes))\
+                .filter(Language.active == True)\
+                .order_by(Languoid.id, TreeClosureTable.depth):
+            lineage = res.setdefault(gc, [])
+            if pk is not None:
+                lineage.append(Ancestor(pk, id_, name, level))
+        return res
+
+    def get_classification_path(self):
+        """
+        :return: List of dicts with id and name of the ancestors, top-level family first.
+        """
+        if self.lineage is not None:
+            return self.lineage
+        # lineage has not been computed yet, e.g. for a languoid added since.
+        return [{'id': l.id, 'name': l.name} for l in reversed(self.get_lineage())]
 
     @property
     def github_url(self):
-        path = [self.id]
-        for l in self.get_ancestors():
-            path.append(l.id)
-        return github('languoids/tree/{0}/md.ini'.format('/'.join(reversed(path))))
+        path = [l['id'] for l in self.get_classification_path()]
+        path.append(self.id)
+        return github('languoids/tree/{0}/md.ini'.format('/'.join(path)))
 
     def __json__(self, req=None, core=False):
         def ancestor(l):
-            r = {"name": l.name, "id": l.id}
+            r = {"name": l['name'], "id": l['id']}
             if req:
-                r['url'] = req.resource_url(l)
+                r['url'] = req.route_url('language', id=l['id'])
             return r
         res = super(Languoid, self).__json__(req)
+        # the nested set intervals and the lineage are an implementation detail of tree
+        # queries, the lineage is serialized as classification below.
+        for col in ['lft', 'rgt', 'lineage']:
+            res.pop(col, None)
         if not core:
-            res['classification'] = [ancestor(l) for l in reversed(list(self.get_ancestors()))]
+            res['classification'] = [ancestor(l) for l in self.get_classification_path()]
             if self.iso_code:
                 res[IdentifierType.iso.value] = self.iso_code
             res['macroareas'] = {ma.id: ma.name for ma in self.macroareas}
@@ -330,17 +414,17 @@ class Languoid(CustomModelMixin, Language):
             its descendants.
         """
 
-        child_pks = DBSession.query(Languoid.pk)\
-            .filter(Languoid.father_pk == self.pk).subquery()
+        child = aliased(Languoid, flat=True)
         return DBSession.query(
-            TreeClosureTable.parent_pk,
-            Language.name,
-            Language.longitude,
-            Language.latitude,
-            Language.id)\
-            .filter(Language.pk == TreeClosureTable.child_pk)\
-            .filter(TreeClosureTable.parent_pk.in_(child_pks))\
-            .filter(Language.latitude != None)
+            child.pk,
+            Languoid.name,
+            Languoid.longitude,
+            Languoid.latitude,
+            Languoid.id)\
+            .select_from(Languoid)\
+            .join(child, in_subtree(Languoid, child))\
+            .filter(child.father_pk == self.pk)\
+            .filter(Languoid.latitude != None)
 
     def classification(self, type_):
         assert type_ in ['fc', 'sc']
@@ -389,8 +473,19 @@ class Languoid(CustomModelMixin, Language):
         """
         res = self._crefs('sc')
         if not res:
-            if self.father:
-                res = self.father.screfs
+            lineage = [l.pk for l in self.get_lineage()]
+            if lineage:
+                # look up the justifications of all ancestors at once, then pick the closest.
+                refs = {}
+                for vs in DBSession.query(ValueSet)\
+                        .join(Parameter)\
+                        .filter(Parameter.id == 'sc')\
+                        .filter(ValueSet.language_pk.in_(lineage))\
+                        .options(joinedload(ValueSet.references)):
+                    refs[vs.language_pk] = list(vs.references)
+                for pk in lineage:
+                    if refs.get(pk):
+                        return refs[pk]
         return res
 
     def __rdf__(self, request):
@@ -419,49 +514,40 @@ class Languoid(CustomModelMixin, Language):
             yield 'dcterms:spatial', 'http://www.geonames.org/countries/%s/' % country.id
 
     def jqtree(self, icon_map=None):
-        tree_ = []
-        children_map = {}
-        children_of_self = [c.pk for c in self.children]
-
-        query = DBSession.query(
-            Languoid.father_pk,
-            Languoid.pk, Languoid.id, Languoid.name,
-            Languoid.latitude, Languoid.hid,
-            cast(Languoid.level, Text), cast(Languoid.status, Text),
-            Languoid.child_language_count, TreeClosureTable.depth)\
-        .select_from(Languoid).join(TreeClosureTable,
-            Languoid.pk == TreeClosureTable.child_pk)\
-        .filter(TreeClosureTable.parent_pk == (self.family_pk or self.pk))\
-        .order_by(TreeClosureTable.depth, Languoid.name)
-
-        for row in query:
-            fpk, cpk, id_, name, lat, hid, level, status, clc, depth = row
-            if hid and len(hid) != 3:
-                hid = None
-
-            label = name
-            if clc:
-                label += ' (%s)' % clc
-            #label = '%s [%s]' % (name, id_)
-            #if level == 'language' and hid and len(hid) == 3:
-            #    label += '[%s]' % hid
-            node = {'id': id_, 'pk': cpk, 'iso': hid, 'level': level, 'status': status, 'label': label, 'children': []}
-            if icon_map and id_ == self.id and lat:
-                node['map_marker'] = icon_map[cpk]
-            if cpk in children_of_self:
-                node['child'] = True
-                if icon_map and (level == 'family' or lat):
-                    node['map_marker'] = icon_map[cpk]
-            children_map[cpk] = node['children']
-
-            if not fpk:
-                tree_.append(node)
-            else:
-                if fpk not in children_map:
-                    # this can be the case for dialects attached to inactive nodes
-                    continue
-                children_map[fpk].append(node)
-        return tree_
+        """
+        :return: The tree of the family of self as nodes for jqTree, with self and its
+        children marked.
+        """
+        from glottolog3.tree import get_family_tree
+
+        attrs = {}
+        if icon_map and self.latitude:
+            attrs[self.pk] = {'map_marker': icon_map[self.pk]}
+        for child in self.children:
+            attrs[child.pk] = {'child': True}
+            if icon_map and (child.level == LanguoidLevel.family or child.latitude):
+                attrs[child.pk]['map_marker'] = icon_map[child.pk]
+        return get_family_tree(self.family_pk or self.pk).overlay(attrs)
+
+# index for subtree queries, see in_subtree
+languoid_family_lft_index = Index(
+    'languoid_family_lft_key',
+    func.coalesce(Languoid.__table__.c.family_pk, Languoid.__table__.c.pk),
+    Languoid.__table__.c.lft)
+
+
+def in_subtree(node, root, proper=False):
+    """
+    :param node: Languoid instance or (aliased) Languoid entity.
+    :param root: Languoid instance or (aliased) Languoid entity.
+    :param proper: Flag signaling whether to exclude root itself.
+    :return: SQL criterion for node being part of the subtree rooted at root.
+    """
+    return and_(
+        func.coalesce(node.family_pk, node.pk) == func.coalesce(root.family_pk, root.pk),
+        node.lft > root.lft if proper else node.lft >= root.lft,
+        node.lft <= root.rgt)
+
 
 def validate_unique(name, type):
     query = DBSession.query(Languoid)\
@@ -545,6 +631,9 @@ class LanguoidSchema(Schema):
 
     identifiers = fields.Method("get_identifiers")
 
+    # glottocode of the father, to place a languoid in the tree; null for top-level.
+    father = fields.Str(load_only=True, allow_none=True)
+
     descendants = fields.Nested(
         'self', many=True, only=['id', 'name', 'level'], dump_only=True)
     children = fields.Nested(
@@ -556,6 +645,8 @@ class LanguoidSchema(Schema):
         ordered = True
 
     def get_identifiers(self, obj):
+        if isinstance(obj, LanguoidDocument):
+            return IdentifierSchema(many=True).dump(obj.identifiers).data
         ids = DBSession.query(Identifier)\
             .join(LanguageIdentifier, LanguageIdentifier.identifier_pk == Identifier.pk)\
             .join(Languoid, Languoid.pk == LanguageIdentifier.language_pk)\
@@ -564,6 +655,116 @@ class LanguoidSchema(Schema):
         return IdentifierSchema(many=True).dump(ids).data
 
 
+Member = namedtuple('Member', 'id name level')
+IdentifierData = namedtuple('IdentifierData', 'name type description lang')
+Area = namedtuple('Area', 'id name description')
+
+
+def json_list(session, order, *cols):
+    """
+    :return: Query aggregating rows of cols into a JSON array of arrays.
+    """
+    return session.query(func.coalesce(
+        func.json_agg(aggregate_order_by(func.json_build_array(*cols), order)), '[]'))
+
+
+class LanguoidDocument(object):
+    """
+    Read-only stand-in for a Languoid, carrying all data serialized by LanguoidSchema.
+
+    Related objects are aggregated as JSON in correlated subqueries, so the document is
+    read with a single SQL statement instead of one lazy load per relationship.
+    """
+    columns = [
+        'pk', 'id', 'name', 'level', 'latitude', 'longitude', 'hid', 'status',
+        'bookkeeping', 'newick',
+        'child_family_count', 'child_language_count', 'child_dialect_count',
+    ]
+
+    def __init__(self, **kw):
+        self.__dict__.update(kw)
+
+    #: Fields which are computed from related objects.
+    nested = ['descendants', 'children', 'identifiers', 'macroareas', 'countries']
+
+    #: Number of glottocodes per IN clause when reading many documents.
+    chunksize = 500
+
+    @classmethod
+    def get(cls, glottocode, fields=None, session=None):
+        """
+        :param fields: Names of the fields to compute; related objects which are not \
+        requested are not read at all.
+        :return: LanguoidDocument for the active languoid with glottocode or None.
+        """
+        return cls.get_many([glottocode], fields=fields, session=session).get(glottocode)
+
+    @classmethod
+    def get_many(cls, glottocodes, fields=None, session=None):
+        """
+        Read documents with one SQL statement per `chunksize` glottocodes.
+
+        :return: dict mapping glottocodes of active languoids to LanguoidDocuments.
+        """
+        session = session or DBSession
+        nested = [f for f in cls.nested if fields is None or f in fields]
+        member = aliased(Languoid)
+
+        def members(fk):
+            return json_list(
+                session, tuple_(member.name, member.id),
+                member.id, member.name, member.level)\
+                .filter(fk(member) == Languoid.pk)
+
+        identifiers = json_list(
+            session, Identifier.pk,
+            Identifier.name, Identifier.type, Identifier.description, Identifier.lang)\
+            .select_from(LanguageIdentifier)\
+            .join(Identifier, Identifier.pk == LanguageIdentifier.identifier_pk)\
+            .filter(LanguageIdentifier.language_pk == Languoid.pk)
+        macroareas = json_list(
+            session, Macroarea.id, Macroarea.id, Macroarea.name, Macroarea.description)\
+            .select_from(Languoidmacroarea)\
+            .join(Macroarea, Macroarea.pk == Languoidmacroarea.macroarea_pk)\
+            .filter(Languoidmacroarea.languoid_pk == Languoid.pk)
+        countries = json_list(
+            session, Country.name, Country.id, Country.name, Country.description)\
+            .select_from(Languoidcountry)\
+            .join(Country, Country.pk == Languoidcountry.country_pk)\
+            .filter(Languoidcountry.languoid_pk == Languoid.pk)
+
+        subqueries = {
+            'descendants': members(lambda m: m.family_pk),
+            'children': members(lambda m: m.father_pk),
+            'identifiers': identifiers,
+            'macroareas': macroareas,
+            'countries': countries,
+        }
+        query = session.query(*[getattr(Languoid, col) for col in cls.columns] + [
+            subqueries[name].label(name) for name in nested])\
+            .filter(Language.active == True)
+
+        def member_doc(m):
+            return Member(m[0], m[1], LanguoidLevel.from_string(m[2]))
+
+        factories = {
+            'descendants': member_doc,
+            'children': member_doc,
+            'identifiers': lambda i: IdentifierData(*i),
+            'macroareas': lambda a: Area(*a),
+            'countries': lambda c: Area(*c),
+        }
+        res = {}
+        glottocodes = sorted(set(glottocodes))
+        for i in range(0, len(glottocodes), cls.chunksize):
+            for row in query.filter(Languoid.id.in_(glottocodes[i:i + cls.chunksize])):
+                kw = {col: getattr(row, col) for col in cls.columns}
+                for name in nested:
+                    kw[name] = [factories[name](item) for item in getattr(row, name)]
+                res[row.id] = cls(**kw)
+        return res
+
+
 def validate_id_type(type):
     VALID_TYPES = [
         IdentifierType.iso.value,
@@ -742,6 +943,32 @@ class TreeClosureTable(Base):
     depth = Column(Integer)
 
 
+class MapLayer(Base):
+    """Coordinates of the descendants of a languoid as shown on its map, i.e. the rows of
+    `Languoid.get_geocoords`, precomputed by `recreate_map_layers`.
+
+    The hash of the content of the layer - see `recreate_map_layers` - is part of the URL
+    of the layer, so clients may cache it indefinitely.
+    """
+    languoid_pk = Column(
+        Integer, ForeignKey('languoid.pk', ondelete='CASCADE'), nullable=False, unique=True)
+    geocoords = Column(JSONB, nullable=False)
+    hash = Column(Unicode, nullable=False)
+
+
+class NormalizedIdentifier(Base):
+    """Identifier name in the normalized form compared by the search API.
+
+    Kept in a table of its own, because Identifier is a clld core model.
+    """
+    identifier_pk = Column(
+        Integer, ForeignKey('identifier.pk', ondelete='CASCADE'), nullable=False, unique=True)
+    name = Column(Unicode, nullable=False)
+    identifier = relationship(
+        Identifier,
+        backref=backref('normalized', uselist=False, cascade='all, delete-orphan'))
+
+
 class LegacyCode(Base):
     id = Column(String, unique=True)
     version = Column(String)
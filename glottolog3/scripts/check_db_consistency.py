@@ -149,6 +149,40 @@ class TreeClosure(Check):
         return session.query(diff.alias())
 
 
+class TreeIntervals(Check):
+    """Languoid intervals are nested within the interval of the father."""
+
+    def invalid_query(self, session, **kw):
+        father = orm.aliased(Languoid, flat=True)
+        return session.query(Languoid)\
+            .outerjoin(father, Languoid.father_pk == father.pk)\
+            .filter(or_(
+                Languoid.lft == None,  # noqa
+                Languoid.rgt <= Languoid.lft,
+                and_(father.pk != None, or_(  # noqa
+                    Languoid.lft <= father.lft,
+                    Languoid.rgt >= father.rgt))))\
+            .order_by(Languoid.id)
+
+
+class Lineage(Check):
+    """Lineage lists the ancestors of a languoid, ending with the father."""
+
+    def invalid_query(self, session, **kw):
+        father = orm.aliased(Languoid, flat=True)
+        depth = session.query(func.count(TreeClosureTable.parent_pk))\
+            .filter(TreeClosureTable.child_pk == Languoid.pk)\
+            .filter(TreeClosureTable.depth > 0)\
+            .as_scalar()
+        return session.query(Languoid)\
+            .outerjoin(father, Languoid.father_pk == father.pk)\
+            .filter(or_(
+                Languoid.lineage == None,  # noqa
+                func.jsonb_array_length(Languoid.lineage) != depth,
+                Languoid.lineage.op('->')(-1).op('->>')('id') != father.id))\
+            .order_by(Languoid.id)
+
+
 class ChildCounts(Check):
     """Languoids have correct child family/language/dialect counts."""
 
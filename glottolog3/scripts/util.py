@@ -1,10 +1,13 @@
 from __future__ import unicode_literals, print_function
 import re
+from collections import defaultdict
 
+from sqlalchemy import func
 from clld.db.meta import DBSession
 from pyglottolog.references import romanint
 
-from glottolog3.models import TreeClosureTable
+from glottolog3.models import TreeClosureTable, Languoid, MapLayer
+from glottolog3.cache import TREE, GEO, bump_generation
 
 ROMAN = '[ivxlcdmIVXLCDM]+'
 ROMANPATTERN = re.compile(ROMAN + '$')
@@ -15,6 +18,8 @@ SEPPAGESPATTERN = re.compile(
 PAGES_PATTERN = re.compile(
     '(?P<start>{0}|{1})\s*\-\-?\s*(?P<end>{0}|{1})'.format(ROMAN, ARABIC))
 ART_NO_PATTERN = re.compile('\(art\.\s*[0-9]+\)')
+# Number of free interval numbers left when the interval of a languoid is widened.
+INTERVAL_GAP = 100
 
 
 def get_int(s):
@@ -148,3 +153,395 @@ def recreate_treeclosure(session=None):
     for s in sql:
         session.execute(s)
     session.execute('COMMIT')
+
+
+def move_languoid(pk, father_pk, session=None):
+    """
+    Move the subtree rooted at a languoid below a new father, see move_languoids.
+    """
+    move_languoids([pk], father_pk, session=session)
+
+
+def move_languoids(pks, father_pk, session=None):
+    """
+    Move the subtrees rooted at languoids below a new father.
+
+    In contrast to recreate_treeclosure, only the treeclosuretable rows of the moved
+    subtrees and the family_pk and child_*_count attributes of the subtrees and their old
+    and new ancestors are updated - with a fixed number of set-based statements. Likewise,
+    only the intervals (see `insert_intervals`) and lineages of the subtrees and the map
+    layers of the old and new ancestors are updated. Nothing is committed, so the update
+    is part of the transaction of the edit.
+
+    :param father_pk: pk of the new father or None, to make the languoids top-level.
+    :raise ValueError: if the new father is part of one of the subtrees.
+    """
+    if session is None:
+        session = DBSession
+    session.flush()
+    params = dict(pks=list(set(pks)), father_pk=father_pk)
+
+    # Languoids which were just added have no closure row and no counts yet.
+    session.execute("""\
+INSERT INTO treeclosuretable (created, updated, active, child_pk, parent_pk, depth)
+SELECT now(), now(), true, l.pk, l.pk, 0
+FROM languoid AS l
+WHERE l.pk = ANY(:pks) AND NOT EXISTS (
+  SELECT 1 FROM treeclosuretable WHERE child_pk = l.pk AND parent_pk = l.pk)""", params)
+    session.execute("""\
+UPDATE languoid SET
+  child_family_count = coalesce(child_family_count, 0),
+  child_language_count = coalesce(child_language_count, 0),
+  child_dialect_count = coalesce(child_dialect_count, 0),
+  lft = coalesce(lft, 1),
+  rgt = coalesce(rgt, 2),
+  lineage = coalesce(lineage, '[]')
+WHERE pk = ANY(:pks) AND (child_family_count IS NULL OR lft IS NULL)""", params)
+
+    if father_pk is not None:
+        if session.execute("""\
+SELECT 1 FROM treeclosuretable WHERE parent_pk = ANY(:pks) AND child_pk = :father_pk""",
+                           params).scalar():
+            raise ValueError('A languoid cannot be moved below itself or its descendants')
+    params['pks'] = [pk for pk, in session.execute("""\
+SELECT pk FROM languoid WHERE pk = ANY(:pks) AND father_pk IS DISTINCT FROM :father_pk""",
+                                                   params)]
+    if not params['pks']:
+        return
+
+    # The statements below require disjoint subtrees, so languoids below other languoids
+    # to be moved are moved first.
+    nested = [pk for pk, in session.execute("""\
+SELECT DISTINCT child_pk FROM treeclosuretable
+WHERE parent_pk = ANY(:pks) AND child_pk = ANY(:pks) AND depth > 0""", params)]
+    if nested:
+        move_languoids(nested, father_pk, session=session)
+        params['pks'] = [pk for pk in params['pks'] if pk not in set(nested)]
+
+    # The map layers of the old and new ancestors change.
+    layers = [pk for pk, in session.execute("""\
+SELECT parent_pk FROM treeclosuretable WHERE child_pk = ANY(:pks) AND depth > 0
+UNION SELECT parent_pk FROM treeclosuretable WHERE child_pk = :father_pk""", params)]
+
+    # Counts of the subtrees are subtracted from the old and added to the new ancestors.
+    counts = """\
+WITH subtree AS (
+  SELECT
+    t.parent_pk AS pk,
+    count(nullif(l.level != 'family', true)) AS families,
+    count(nullif(l.level != 'language', true)) AS languages,
+    count(nullif(l.level != 'dialect', true)) AS dialects
+  FROM treeclosuretable AS t JOIN languoid AS l ON l.pk = t.child_pk
+  WHERE t.parent_pk = ANY(:pks)
+  GROUP BY t.parent_pk
+), delta AS (
+  SELECT
+    a.parent_pk AS pk,
+    sum(s.families) AS families,
+    sum(s.languages) AS languages,
+    sum(s.dialects) AS dialects
+  FROM treeclosuretable AS a JOIN subtree AS s ON a.child_pk = s.pk AND a.depth > 0
+  GROUP BY a.parent_pk)
+UPDATE languoid AS l SET
+  child_family_count = coalesce(l.child_family_count, 0) {0} d.families,
+  child_language_count = coalesce(l.child_language_count, 0) {0} d.languages,
+  child_dialect_count = coalesce(l.child_dialect_count, 0) {0} d.dialects
+FROM delta AS d
+WHERE l.pk = d.pk"""
+    sql = [
+        counts.format('-'),
+        """\
+DELETE FROM treeclosuretable AS x
+USING treeclosuretable AS s, treeclosuretable AS a
+WHERE s.parent_pk = ANY(:pks) AND a.child_pk = s.parent_pk AND a.depth > 0
+AND x.child_pk = s.child_pk AND x.parent_pk = a.parent_pk""",
+        """\
+INSERT INTO treeclosuretable (created, updated, active, child_pk, parent_pk, depth)
+SELECT now(), now(), true, s.child_pk, a.parent_pk, a.depth + s.depth + 1
+FROM treeclosuretable AS a, treeclosuretable AS s
+WHERE a.child_pk = :father_pk AND s.parent_pk = ANY(:pks)""",
+        counts.format('+'),
+        "UPDATE languoid SET father_pk = :father_pk WHERE pk = ANY(:pks)",
+        # The top-level family of the new father is the family of all subtrees.
+        """\
+UPDATE languoid AS l SET family_pk = CASE WHEN l.pk = s.parent_pk THEN f.family_pk
+  ELSE coalesce(f.family_pk, s.parent_pk) END
+FROM treeclosuretable AS s, (
+  SELECT (SELECT coalesce(family_pk, pk) FROM languoid WHERE pk = :father_pk)
+  AS family_pk) AS f
+WHERE s.parent_pk = ANY(:pks) AND l.pk = s.child_pk""",
+    ]
+    for s in sql:
+        session.execute(s, params)
+    if father_pk is not None:
+        insert_intervals(params['pks'], father_pk, session=session)
+    # The lineage of the subtrees starts with the lineage of the new father:
+    session.execute("""\
+WITH prefix AS (
+  SELECT coalesce((
+    SELECT coalesce(f.lineage, '[]') || jsonb_build_object('id', lf.id, 'name', lf.name)
+    FROM languoid AS f JOIN language AS lf ON lf.pk = f.pk
+    WHERE f.pk = :father_pk), '[]') AS lineage
+), moved AS (
+  SELECT s.child_pk AS pk, jsonb_array_length(coalesce(r.lineage, '[]')) AS n
+  FROM treeclosuretable AS s JOIN languoid AS r ON r.pk = s.parent_pk
+  WHERE s.parent_pk = ANY(:pks)
+)
+UPDATE languoid AS l SET lineage = p.lineage || coalesce((
+  SELECT jsonb_agg(x.e ORDER BY x.i)
+  FROM jsonb_array_elements(l.lineage) WITH ORDINALITY AS x(e, i)
+  WHERE x.i > m.n), '[]')
+FROM moved AS m, prefix AS p
+WHERE l.pk = m.pk""", params)
+    bump_generation(TREE, session=session)
+    bump_generation(GEO, session=session)
+    recreate_map_layers(layers, session=session)
+    # ORM instances loaded before now carry stale tree attributes.
+    session.expire_all()
+
+
+def insert_intervals(pks, father_pk, session=None):
+    """
+    Number the subtrees rooted at languoids which were just moved below a new father,
+    within the interval of the father.
+
+    The subtrees are numbered consecutively - in their current order - in the free
+    numbers after the last child of the father. Only if these do not suffice, the interval of the
+    father is widened - by shifting the numbers of its ancestors and of the languoids
+    after it in the family - leaving `INTERVAL_GAP` free numbers for later insertions.
+    So intervals may have gaps, and children are not numbered in order of name anymore
+    until the next `recreate_intervals`.
+    """
+    if session is None:
+        session = DBSession
+    family_pk, lft, rgt = session.execute("""\
+SELECT coalesce(family_pk, pk), lft, rgt FROM languoid WHERE pk = :pk""",
+                                          dict(pk=father_pk)).first()
+    params = dict(pks=list(pks), father_pk=father_pk, family_pk=family_pk, lft=lft, rgt=rgt)
+    moved = """\
+EXISTS (SELECT 1 FROM treeclosuretable AS s
+  WHERE s.parent_pk = ANY(:pks) AND s.child_pk = l.pk)"""
+
+    # The last number in use is the end of the interval of the last child, i.e. of the
+    # outermost ancestor below the father of the last descendant in depth-first order.
+    last = session.execute("""\
+SELECT max(a.rgt)
+FROM treeclosuretable AS t JOIN languoid AS a ON a.pk = t.parent_pk
+WHERE a.lft > :lft AND t.child_pk = (
+  SELECT l.pk FROM languoid AS l
+  WHERE coalesce(l.family_pk, l.pk) = :family_pk AND l.lft > :lft AND l.lft < :rgt
+  AND NOT {0}
+  ORDER BY l.lft DESC LIMIT 1)""".format(moved), params).scalar() or lft
+
+    # Each subtree takes two numbers per languoid.
+    roots = session.execute("""\
+SELECT parent_pk, 2 * count(*) FROM treeclosuretable
+WHERE parent_pk = ANY(:pks) GROUP BY parent_pk ORDER BY parent_pk""", params).fetchall()
+    missing = sum(width for _, width in roots) - (rgt - last - 1)
+    if missing > 0:
+        params['shift'] = missing + INTERVAL_GAP
+        session.execute("""\
+UPDATE languoid AS l SET lft = l.lft + :shift, rgt = l.rgt + :shift
+WHERE coalesce(l.family_pk, l.pk) = :family_pk AND l.lft > :rgt AND NOT {0}""".format(
+            moved), params)
+        session.execute("""\
+UPDATE languoid AS l SET rgt = l.rgt + :shift
+FROM treeclosuretable AS t
+WHERE t.child_pk = :father_pk AND l.pk = t.parent_pk""", params)
+
+    starts = []
+    for _, width in roots:
+        starts.append(last + 1)
+        last += width
+    # The numbers of each subtree are replaced by consecutive numbers in the same order.
+    session.execute("""\
+UPDATE languoid AS l SET lft = n.lft, rgt = n.rgt
+FROM (
+  SELECT e.pk,
+    min(e.number) FILTER (WHERE NOT e.is_rgt) AS lft,
+    min(e.number) FILTER (WHERE e.is_rgt) AS rgt
+  FROM (
+    SELECT x.pk, x.is_rgt,
+      x.start + row_number() OVER (PARTITION BY x.root ORDER BY x.n) - 1 AS number
+    FROM (
+      SELECT v.pk AS root, v.start, l.pk, y.n, y.is_rgt
+      FROM unnest(:roots, :starts) AS v(pk, start)
+      JOIN treeclosuretable AS s ON s.parent_pk = v.pk
+      JOIN languoid AS l ON l.pk = s.child_pk
+      CROSS JOIN LATERAL (VALUES (l.lft, false), (l.rgt, true)) AS y(n, is_rgt)
+    ) AS x
+  ) AS e
+  GROUP BY e.pk
+) AS n
+WHERE l.pk = n.pk""", dict(roots=[pk for pk, _ in roots], starts=starts))
+
+
+def recreate_intervals(roots=None, session=None):
+    """
+    Number the languoids of each top-level family in depth-first order, with children in
+    order of name, to compute the nested set intervals lft and rgt.
+
+    :param roots: pks of the top-level languoids of the trees to renumber, None for all.
+    """
+    if session is None:
+        session = DBSession
+    session.flush()
+    if roots is None:
+        # Migrate databases created before the interval columns were added:
+        for sql in [
+            "ALTER TABLE languoid ADD COLUMN IF NOT EXISTS lft integer",
+            "ALTER TABLE languoid ADD COLUMN IF NOT EXISTS rgt integer",
+            """CREATE INDEX IF NOT EXISTS languoid_family_lft_key
+            ON languoid (coalesce(family_pk, pk), lft)""",
+        ]:
+            session.execute(sql)
+
+    query = session.query(Languoid.pk, Languoid.father_pk)\
+        .order_by(Languoid.name, Languoid.pk)
+    if roots is not None:
+        query = query.filter(
+            func.coalesce(Languoid.family_pk, Languoid.pk).in_(list(roots)))
+    tops, children = [], defaultdict(list)
+    for pk, father_pk in query:
+        if father_pk is None:
+            tops.append(pk)
+        else:
+            children[father_pk].append(pk)
+
+    pks, lfts, rgts = [], [], []
+    for top in tops:
+        number, stack, lft = 0, [(top, False)], {}
+        while stack:
+            pk, visited = stack.pop()
+            number += 1
+            if visited:
+                pks.append(pk)
+                lfts.append(lft[pk])
+                rgts.append(number)
+            else:
+                lft[pk] = number
+                stack.append((pk, True))
+                stack.extend((c, False) for c in reversed(children[pk]))
+    if not pks:
+        return
+    session.execute("""\
+UPDATE languoid AS l SET lft = v.lft, rgt = v.rgt
+FROM unnest(:pks, :lfts, :rgts) AS v(pk, lft, rgt)
+WHERE l.pk = v.pk AND (l.lft IS DISTINCT FROM v.lft OR l.rgt IS DISTINCT FROM v.rgt)""",
+                    dict(pks=pks, lfts=lfts, rgts=rgts))
+
+
+def recreate_lineages(roots=None, session=None):
+    """
+    Compute the lineage attribute of languoids, i.e. the list of ids and names of the
+    ancestors, top-level family first.
+
+    :param roots: pks of the top-level languoids of the trees to update, None for all.
+    """
+    if session is None:
+        session = DBSession
+    session.flush()
+    if roots is None:
+        # Migrate databases created before the lineage column was added:
+        session.execute("ALTER TABLE languoid ADD COLUMN IF NOT EXISTS lineage jsonb")
+    elif not roots:
+        return
+    session.execute("""\
+WITH RECURSIVE tree(pk, lineage) AS (
+  SELECT pk, '[]'::jsonb FROM languoid
+  WHERE father_pk IS NULL AND (:all OR pk = ANY(:roots))
+UNION ALL
+  SELECT c.pk, t.lineage || jsonb_build_object('id', f.id, 'name', f.name)
+  FROM tree AS t
+  JOIN language AS f ON f.pk = t.pk
+  JOIN languoid AS c ON c.father_pk = t.pk
+)
+UPDATE languoid AS l SET lineage = t.lineage
+FROM tree AS t
+WHERE l.pk = t.pk AND l.lineage IS DISTINCT FROM t.lineage""",
+                    dict(all=roots is None, roots=list(roots or [])))
+
+
+def rename_in_lineages(pk, session=None):
+    """
+    Update the entry of a renamed languoid in the lineages of its descendants.
+    """
+    if session is None:
+        session = DBSession
+    session.flush()
+    # The entry of the languoid follows the entries of its ancestors:
+    session.execute("""\
+UPDATE languoid AS l SET lineage = jsonb_set(
+  l.lineage,
+  ARRAY[jsonb_array_length(coalesce(r.lineage, '[]'))::text],
+  jsonb_build_object('id', lr.id, 'name', lr.name))
+FROM treeclosuretable AS s, languoid AS r, language AS lr
+WHERE s.parent_pk = :pk AND s.depth > 0 AND l.pk = s.child_pk
+AND r.pk = :pk AND lr.pk = :pk""", dict(pk=pk))
+    session.expire_all()
+
+
+def recreate_map_layers(pks=None, session=None):
+    """
+    Compute the map layers of languoids with children, i.e. the coordinates of their
+    descendants grouped by child, with a hash of everything the rendered layer depends
+    on: the point of the languoid itself, the order of the children - which determines
+    their icons, see `glottolog3.util.get_icon_map` - and the coordinates.
+
+    :param pks: pks of the languoids whose layers to update, None for all.
+    """
+    if session is None:
+        session = DBSession
+    session.flush()
+    if pks is None:
+        # Migrate databases created before the maplayer table was added:
+        MapLayer.__table__.create(session.connection(), checkfirst=True)
+    elif not pks:
+        return
+    params = dict(all=pks is None, pks=list(pks or []))
+    session.execute(
+        "DELETE FROM maplayer WHERE :all OR languoid_pk = ANY(:pks)", params)
+    session.execute("""\
+WITH layer AS (
+  SELECT
+    c.father_pk AS pk,
+    coalesce(jsonb_agg(
+      jsonb_build_array(c.pk, l.name, l.longitude, l.latitude, l.id) ORDER BY d.lft
+    ) FILTER (WHERE l.latitude IS NOT NULL), '[]') AS geocoords
+  FROM languoid AS c
+  JOIN languoid AS d
+    ON coalesce(d.family_pk, d.pk) = coalesce(c.family_pk, c.pk)
+    AND d.lft >= c.lft AND d.lft <= c.rgt
+  JOIN language AS l ON l.pk = d.pk
+  WHERE c.father_pk IS NOT NULL AND (:all OR c.father_pk = ANY(:pks))
+  GROUP BY c.father_pk
+)
+INSERT INTO maplayer (created, updated, active, languoid_pk, geocoords, hash)
+SELECT now(), now(), true, layer.pk, layer.geocoords, left(md5(jsonb_build_array(
+  jsonb_build_array(f.pk, f.name, f.longitude, f.latitude, f.id),
+  (SELECT jsonb_agg(c.pk ORDER BY lc.name, lc.id)
+   FROM languoid AS c JOIN language AS lc ON lc.pk = c.pk
+   WHERE c.father_pk = layer.pk),
+  layer.geocoords)::text), 16)
+FROM layer JOIN language AS f ON f.pk = layer.pk""",
+                    params)
+
+
+def update_level_counts(pk, old_level, new_level, session=None):
+    """
+    Update the child_*_count attributes of the ancestors of a languoid whose level changed.
+    """
+    if session is None:
+        session = DBSession
+    old_level, new_level = [getattr(l, 'value', l) for l in (old_level, new_level)]
+    if old_level == new_level:
+        return
+    session.flush()
+    session.execute("""\
+UPDATE languoid SET
+  child_{0}_count = child_{0}_count - 1,
+  child_{1}_count = child_{1}_count + 1
+WHERE pk IN (
+  SELECT parent_pk FROM treeclosuretable WHERE child_pk = :pk AND depth > 0)""".format(
+        old_level, new_level), dict(pk=pk))
+    session.expire_all()
@@ -0,0 +1,438 @@
+"""
+Identifier search backed by pg_trgm indexes.
+
+Identifier names are normalized - transliterated to ASCII and lowercased - once, when they
+are written, and stored in the NormalizedIdentifier table. Search terms are normalized the
+same way in Python, so the database only compares pre-normalized strings:
+
+- a GIN trigram index serves the substring (``LIKE '%term%'``) searches,
+- a btree index serves the ``whole`` (equality) searches,
+- the GIN trigram index also provides candidates for fuzzy searches (pg_trgm's ``%``
+  similarity operator), which are then checked for bounded edit distance with
+  fuzzystrmatch's ``levenshtein_less_equal``.
+
+Matching, ranking and aggregation per languoid all happen in the database, so only the
+top-ranked languoids are transferred.
+"""
+from __future__ import unicode_literals
+from bisect import bisect_left
+from collections import namedtuple
+
+from unidecode import unidecode
+from sqlalchemy import (
+    and_, or_, case, cast, func, literal, tuple_, text, column,
+    Boolean, Float, Integer, Unicode,
+)
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+
+from clld.db.meta import DBSession
+from clld.db.models.common import (
+    Language, LanguageIdentifier, Identifier, IdentifierType,
+)
+
+from glottolog3.models import Languoid, NormalizedIdentifier, GLOTTOCODE_PATTERN
+
+#: Default number of languoids returned for one search ...
+LIMIT = 100
+#: ... and the maximal number clients may request.
+MAX_LIMIT = 500
+#: Fuzzy matching is only attempted for terms up to this length.
+MAX_FUZZY_LEN = 64
+#: Default and maximal number of name completions.
+SUGGEST_LIMIT = 10
+MAX_SUGGEST_LIMIT = 50
+#: Default number of languoids returned per term of a batch search.
+BATCH_LIMIT = 10
+#: Maximal number of terms in one batch search ...
+MAX_BATCH = 10000
+#: ... and the number of terms matched by one SQL statement.
+BATCH_CHUNK = 500
+
+#: Identifier types which are looked up by exact match.
+CODE_TYPES = [
+    IdentifierType.iso.value,
+    IdentifierType.wals.value,
+    IdentifierType.multitree.value,
+    IdentifierType.ethnologue.value,
+]
+#: Score of code matches, ranking them ahead of all name matches.
+CODE_SCORE = -1.0
+
+DDL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm WITH SCHEMA public",
+    "CREATE EXTENSION IF NOT EXISTS fuzzystrmatch WITH SCHEMA public",
+    """CREATE INDEX IF NOT EXISTS normalizedidentifier_name_trgm_idx
+    ON normalizedidentifier USING gin (name gin_trgm_ops)""",
+    """CREATE INDEX IF NOT EXISTS normalizedidentifier_name_idx
+    ON normalizedidentifier (name text_pattern_ops)""",
+    "ANALYZE normalizedidentifier",
+]
+
+
+def normalize(name):
+    """
+    Transliterate to ASCII, lowercase and collapse whitespace.
+    """
+    return ' '.join(unidecode('{0}'.format(name)).lower().split())
+
+
+def index_identifier(identifier):
+    """
+    Store - or update - the normalized name of an identifier.
+    """
+    if identifier.normalized is None:
+        identifier.normalized = NormalizedIdentifier(name=normalize(identifier.name))
+    else:
+        identifier.normalized.name = normalize(identifier.name)
+
+
+def index_identifiers(session=None, chunksize=5000):
+    """
+    Store normalized names for all identifiers which do not have one yet.
+    """
+    session = session or DBSession
+    missing = session.query(Identifier.pk, Identifier.name)\
+        .outerjoin(NormalizedIdentifier,
+                   NormalizedIdentifier.identifier_pk == Identifier.pk)\
+        .filter(NormalizedIdentifier.pk == None)\
+        .order_by(Identifier.pk)
+    rows = missing.all()
+    for i in range(0, len(rows), chunksize):
+        session.bulk_insert_mappings(NormalizedIdentifier, [
+            dict(identifier_pk=pk, name=normalize(name))
+            for pk, name in rows[i:i + chunksize]])
+    return len(rows)
+
+
+def create_indexes(session=None):
+    """
+    Fill the normalizedidentifier table and create its indexes.
+
+    All steps are idempotent, so this doubles as migration for existing databases.
+    """
+    session = session or DBSession
+    NormalizedIdentifier.__table__.create(session.connection(), checkfirst=True)
+    index_identifiers(session)
+    for sql in DDL:
+        session.execute(sql)
+
+
+def name_filter(term, whole=False):
+    """
+    :return: SQL filter criterion matching normalized identifier names.
+    """
+    term = normalize(term)
+    if whole:
+        return NormalizedIdentifier.name == term
+    return NormalizedIdentifier.name.contains(term)
+
+
+def max_distance(term):
+    """
+    :return: Maximal edit distance for fuzzy matches of term.
+    """
+    return 1 if len(term) <= 5 else 2
+
+
+def distance(name, term, max_):
+    """
+    :return: SQL expression for the edit distance between name and term, or max_ + 1 if \
+    it is bigger than max_.
+    """
+    # levenshtein functions are limited to 255 characters.
+    return case(
+        [(func.length(name) <= 255, func.levenshtein_less_equal(name, term, max_))],
+        else_=max_ + 1)
+
+
+def score(name, term, fuzzy=None):
+    """
+    Rank a normalized identifier name against a normalized search term; lower is better.
+
+    :param fuzzy: Maximal edit distance of fuzzy matches - an int or an SQL expression - \
+    or None if fuzzy matching is off.
+
+    Exact matches come first, then prefix matches, then matches at the start of a word,
+    then any other substring match. Within each tier, names which are covered to a
+    larger extent by the term are preferred. Fuzzy matches come last, ordered by edit
+    distance and trigram similarity.
+    """
+    coverage = cast(func.length(term), Float) / func.length(name)
+    tiers = [
+        (name == term, literal(0.0)),
+        (name.startswith(term), 1 - coverage),
+        (name.contains(literal(' ') + term), 2 - coverage),
+    ]
+    if fuzzy is None:
+        return case(tiers, else_=3 - coverage)
+    tiers.append((name.contains(term), 3 - coverage))
+    return case(
+        tiers,
+        else_=3 + cast(distance(name, term, fuzzy), Float) - func.similarity(name, term))
+
+
+def ranked_languoids(term,
+                     whole=False,
+                     multilingual=True,
+                     fuzzy=False,
+                     limit=LIMIT,
+                     after=None,
+                     exclude=None,
+                     session=None):
+    """
+    :param fuzzy: Flag signaling whether to include names within a small edit distance.
+    :param after: (score, name, id) sort key of the last languoid of the previous page.
+    :param exclude: Glottocodes of languoids to leave out.
+    :return: Query selecting (id, name, hid, level, identifiers, score) of the best \
+    matching active languoids, where identifiers is the list of matching identifier \
+    names, best match first.
+    """
+    session = session or DBSession
+    name, nterm = NormalizedIdentifier.name, normalize(term)
+    max_ = max_distance(nterm) if fuzzy and len(term) <= MAX_FUZZY_LEN else None
+    match = name_filter(term, whole=whole)
+    if max_:
+        # The similarity operator % selects candidates via the trigram index (escaped
+        # for the DBAPI's pyformat paramstyle):
+        match = or_(match, and_(
+            name.op('%%')(nterm), distance(name, nterm, max_) <= max_))
+    filters = [Language.active == True, match]
+    if not multilingual:
+        # restrict to English identifiers
+        filters.append(func.coalesce(Identifier.lang, '').in_(('', 'eng', 'en')))
+
+    matches = session.query(
+        LanguageIdentifier.language_pk.label('pk'),
+        Identifier.name.label('name'),
+        func.min(score(name, nterm, fuzzy=max_)).label('score'))\
+        .join(Identifier, Identifier.pk == LanguageIdentifier.identifier_pk)\
+        .join(NormalizedIdentifier, NormalizedIdentifier.identifier_pk == Identifier.pk)\
+        .join(Language, Language.pk == LanguageIdentifier.language_pk)\
+        .filter(and_(*filters))\
+        .group_by(LanguageIdentifier.language_pk, Identifier.name)\
+        .subquery()
+    ranked = session.query(
+        matches.c.pk,
+        func.min(matches.c.score).label('score'),
+        func.array_agg(
+            aggregate_order_by(matches.c.name, matches.c.score)).label('identifiers'))\
+        .group_by(matches.c.pk)\
+        .subquery()
+    query = session.query(
+        Languoid.id, Languoid.name, Languoid.hid, Languoid.level,
+        ranked.c.identifiers, ranked.c.score)\
+        .select_from(Languoid)\
+        .join(ranked, ranked.c.pk == Languoid.pk)
+    if after:
+        query = query.filter(
+            tuple_(ranked.c.score, Languoid.name, Languoid.id) > tuple_(*after))
+    if exclude:
+        query = query.filter(Languoid.id.notin_(list(exclude)))
+    return query.order_by(ranked.c.score, Languoid.name, Languoid.id).limit(limit)
+
+
+def batch_query(terms, session=None):
+    """
+    Match many terms in one statement, by joining identifiers against the terms passed
+    as unnested arrays.
+
+    :param terms: list of (term, whole, multilingual, fuzzy, limit) tuples.
+    :return: Query selecting (idx, id, name, hid, level, identifiers, score) of the best \
+    matching active languoids per term, ordered by index of the term in `terms` and rank.
+    """
+    session = session or DBSession
+    terms = [(normalize(t[0]),) + tuple(t[1:]) for t in terms]
+    batch = text(
+        'SELECT * FROM unnest(:idx, :term, :whole, :multilingual, :fuzzy, :lim) '
+        'AS t(idx, term, whole, multilingual, fuzzy, lim)')\
+        .bindparams(
+            idx=list(range(len(terms))),
+            term=[t[0] for t in terms],
+            whole=[bool(t[1]) for t in terms],
+            multilingual=[bool(t[2]) for t in terms],
+            # fuzzy matching is signaled by a positive maximal edit distance:
+            fuzzy=[max_distance(t[0]) if t[3] and len(t[0]) <= MAX_FUZZY_LEN else 0
+                   for t in terms],
+            lim=[t[4] for t in terms])\
+        .columns(
+            column('idx', Integer),
+            column('term', Unicode),
+            column('whole', Boolean),
+            column('multilingual', Boolean),
+            column('fuzzy', Integer),
+            column('lim', Integer))\
+        .alias('batch')
+
+    name, nterm = NormalizedIdentifier.name, batch.c.term
+    match = or_(
+        and_(batch.c.whole, name == nterm),
+        and_(~batch.c.whole, name.contains(nterm)),
+        and_(batch.c.fuzzy > 0,
+             name.op('%%')(nterm),
+             distance(name, nterm, batch.c.fuzzy) <= batch.c.fuzzy))
+    english = func.coalesce(Identifier.lang, '').in_(('', 'eng', 'en'))
+
+    matches = session.query(
+        batch.c.idx,
+        batch.c.lim,
+        LanguageIdentifier.language_pk.label('pk'),
+        Identifier.name.label('name'),
+        func.min(score(name, nterm, fuzzy=batch.c.fuzzy)).label('score'))\
+        .select_from(batch)\
+        .join(NormalizedIdentifier, match)\
+        .join(Identifier, Identifier.pk == NormalizedIdentifier.identifier_pk)\
+        .join(LanguageIdentifier, LanguageIdentifier.identifier_pk == Identifier.pk)\
+        .join(Language, Language.pk == LanguageIdentifier.language_pk)\
+        .filter(Language.active == True)\
+        .filter(or_(batch.c.multilingual, english))\
+        .group_by(batch.c.idx, batch.c.lim, LanguageIdentifier.language_pk, Identifier.name)\
+        .subquery()
+    ranked = session.query(
+        matches.c.idx,
+        matches.c.lim,
+        matches.c.pk,
+        func.min(matches.c.score).label('score'),
+        func.array_agg(
+            aggregate_order_by(matches.c.name, matches.c.score)).label('identifiers'))\
+        .group_by(matches.c.idx, matches.c.lim, matches.c.pk)\
+        .subquery()
+    numbered = session.query(
+        ranked.c.idx,
+        ranked.c.lim,
+        Languoid.id.label('id'),
+        Languoid.name.label('name'),
+        Languoid.hid.label('hid'),
+        Languoid.level.label('level'),
+        ranked.c.identifiers,
+        ranked.c.score,
+        func.row_number().over(
+            partition_by=ranked.c.idx,
+            order_by=(ranked.c.score, Languoid.name, Languoid.id)).label('rank'))\
+        .select_from(Languoid)\
+        .join(ranked, ranked.c.pk == Languoid.pk)\
+        .subquery()
+    return session.query(
+        numbered.c.idx,
+        numbered.c.id,
+        numbered.c.name,
+        numbered.c.hid,
+        numbered.c.level,
+        numbered.c.identifiers,
+        numbered.c.score)\
+        .filter(numbered.c.rank <= numbered.c.lim)\
+        .order_by(numbered.c.idx, numbered.c.rank)
+
+
+def batch_search(terms, codes=None, session=None):
+    """
+    :param terms: list of (term, whole, multilingual, fuzzy, limit) tuples.
+    :param codes: CodeIndex to look up terms in, ahead of the name search.
+    :return: Generator of lists of result rows as selected by `batch_query`, one per term \
+    in order. Glottocodes match the languoid with this glottocode.
+    """
+    session = session or DBSession
+    for i in range(0, len(terms), BATCH_CHUNK):
+        chunk = terms[i:i + BATCH_CHUNK]
+        results = [[] for _ in chunk]
+        glottocodes, other = {}, []
+        for j, t in enumerate(chunk):
+            if len(t[0]) == 8 and GLOTTOCODE_PATTERN.match(t[0]):
+                glottocodes.setdefault(t[0], []).append(j)
+            else:
+                other.append(j)
+        if glottocodes:
+            for row in session.query(
+                    literal(0).label('idx'),
+                    Languoid.id, Languoid.name, Languoid.hid, Languoid.level,
+                    literal(None).label('identifiers'), literal(0.0).label('score'))\
+                    .filter(Languoid.id.in_(list(glottocodes))):
+                for j in glottocodes[row.id]:
+                    results[j].append(row)
+        if other:
+            for row in batch_query([chunk[j] for j in other], session=session):
+                results[other[row.idx]].append(row)
+        for t, res in zip(chunk, results):
+            hits = codes.lookup(t[0]) if codes else []
+            if hits:
+                ids = set(hit.id for hit in hits)
+                res = (hits + [row for row in res if row.id not in ids])[:t[4]]
+            yield res
+
+
+CodeMatch = namedtuple('CodeMatch', 'id name hid level identifiers score')
+
+
+class CodeIndex(object):
+    """
+    Exact lookup of active languoids by code identifiers, e.g. ISO 639-3 codes.
+    """
+    def __init__(self, items):
+        """
+        :param items: Iterable of (code, glottocode, name, hid, level) tuples.
+        """
+        self.codes = {}
+        for code, gc, name, hid, level in items:
+            matches = self.codes.setdefault(code.lower(), [])
+            if gc not in set(m.id for m in matches):
+                matches.append(CodeMatch(gc, name, hid, level, [code], CODE_SCORE))
+        for matches in self.codes.values():
+            matches.sort(key=lambda m: (m.name, m.id))
+
+    @classmethod
+    def from_db(cls, session):
+        return cls(session.query(
+            Identifier.name, Languoid.id, Languoid.name, Languoid.hid, Languoid.level)
+                   .join(LanguageIdentifier,
+                         LanguageIdentifier.identifier_pk == Identifier.pk)
+                   .join(Languoid, Languoid.pk == LanguageIdentifier.language_pk)
+                   .filter(Language.active == True)
+                   .filter(Identifier.type.in_(CODE_TYPES)))
+
+    def __len__(self):
+        return len(self.codes)
+
+    def lookup(self, code):
+        """
+        :return: list of CodeMatch objects, in the order of ranked search results.
+        """
+        return list(self.codes.get(code.strip().lower(), []))
+
+
+class PrefixIndex(object):
+    """
+    Name completion over a sorted array of normalized names, looked up by binary search.
+    """
+    def __init__(self, items):
+        """
+        :param items: Iterable of (name, glottocode) pairs.
+        """
+        entries = sorted(set((normalize(name), name, gc) for name, gc in items))
+        self.keys = [key for key, _, _ in entries]
+        self.values = [(name, gc) for _, name, gc in entries]
+
+    @classmethod
+    def from_db(cls, session):
+        return cls(session.query(Identifier.name, Language.id)
+                   .join(LanguageIdentifier,
+                         LanguageIdentifier.identifier_pk == Identifier.pk)
+                   .join(Language, Language.pk == LanguageIdentifier.language_pk)
+                   .filter(Language.active == True)
+                   .filter(Identifier.type == 'name'))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def complete(self, prefix, limit=SUGGEST_LIMIT):
+        """
+        :return: list of the first `limit` (name, glottocode) pairs in order of \
+        normalized name, where the normalized name starts with the normalized prefix.
+        """
+        prefix = normalize(prefix)
+        res = []
+        if not prefix:
+            return res
+        for i in range(bisect_left(self.keys, prefix), len(self.keys)):
+            if len(res) == limit or not self.keys[i].startswith(prefix):
+                break
+            res.append(self.values[i])
+        return res
@@ -0,0 +1,590 @@
+"""
+A compact snapshot of the classification tree, shared by the web workers.
+
+`dbprime` writes the tree to a binary file of flat arrays. The nodes are stored in
+depth-first order, so the descendants of a node are the contiguous range of nodes up to
+the end of its interval:
+
+- pk, index of the father (-1 for top-level languoids) and end of the interval,
+- level and status codes,
+- glottocodes and names as string tables,
+- a permutation of the nodes sorted by pk, for lookup by binary search.
+
+Web workers map the file read-only, so all processes share one copy in the page cache, and
+lineage and subtree lookups are walks over the arrays rather than database queries.
+
+The snapshot is tagged with the generation of the tree (see `glottolog3.cache`). Edits of
+the tree bump the generation, so a stale snapshot is ignored - and callers fall back to
+the database - until the next `dbprime` writes a new one.
+"""
+from __future__ import unicode_literals
+import os
+import sys
+import json
+import mmap
+import struct
+import tempfile
+from array import array
+from collections import namedtuple
+
+from sqlalchemy import func, cast, Text
+from clld.db.meta import DBSession
+
+from glottolog3.cache import (
+    DerivedData, LRUCache, SEARCH, TREE, bump_generation, get_generation,
+)
+from clld.db.models.common import (
+    Language, LanguageIdentifier, Identifier, IdentifierType,
+)
+
+from glottolog3.models import (
+    Languoid, LanguoidLevel, LanguoidStatus, Member, Ancestor, in_subtree,
+)
+
+MAGIC = b'GLTREE01'
+# magic, generation, number of nodes, sizes of the glottocode and name tables in bytes
+HEADER = struct.Struct('<8sqiii')
+INT = struct.Struct('<i')
+BYTE = struct.Struct('<b')
+
+LEVELS = [LanguoidLevel.family, LanguoidLevel.language, LanguoidLevel.dialect]
+STATUSES = [
+    LanguoidStatus.safe,
+    LanguoidStatus.vulnerable,
+    LanguoidStatus.definite,
+    LanguoidStatus.severe,
+    LanguoidStatus.critical,
+    LanguoidStatus.extinct,
+]
+
+Node = namedtuple('Node', 'pk id name level status')
+Relation = namedtuple('Relation', 'lca distance')
+
+
+def snapshot_path(session=None):
+    """
+    :return: Path of the snapshot file for the database bound to session.
+    """
+    path = os.environ.get('GLOTTOLOG_TREE_SNAPSHOT')
+    if path:
+        return path
+    url = (session or DBSession).get_bind().url
+    return os.path.join(
+        tempfile.gettempdir(), 'glottolog3-tree-{0}.bin'.format(url.database))
+
+
+class TreeSnapshot(object):
+    """
+    Read access to the arrays of a snapshot held in a buffer, e.g. a memory map.
+    """
+    def __init__(self, buf):
+        self.buf = buf
+        magic, self.generation, n, ids_size, names_size = HEADER.unpack_from(buf, 0)
+        if magic != MAGIC:
+            raise ValueError('not a tree snapshot')
+        self.size = n
+        offset = HEADER.size
+        for name, length, itemsize in [
+            ('_pks', n, 4),
+            ('_fathers', n, 4),
+            ('_ends', n, 4),
+            ('_by_pk', n, 4),
+            ('_id_offsets', n + 1, 4),
+            ('_name_offsets', n + 1, 4),
+            ('_levels', n, 1),
+            ('_statuses', n, 1),
+            ('_ids', ids_size, 1),
+            ('_names', names_size, 1),
+        ]:
+            setattr(self, name, offset)
+            offset += length * itemsize
+
+    def __len__(self):
+        return self.size
+
+    def _int(self, array_offset, i):
+        return INT.unpack_from(self.buf, array_offset + 4 * i)[0]
+
+    def _str(self, offsets, strings, i):
+        start = self._int(offsets, i)
+        end = self._int(offsets, i + 1)
+        return self.buf[strings + start:strings + end].decode('utf8')
+
+    def pk(self, i):
+        return self._int(self._pks, i)
+
+    def father(self, i):
+        """
+        :return: Index of the father of node i or None.
+        """
+        father = self._int(self._fathers, i)
+        return None if father < 0 else father
+
+    def end(self, i):
+        """
+        :return: Index after the last descendant of node i.
+        """
+        return self._int(self._ends, i)
+
+    def id(self, i):
+        return self._str(self._id_offsets, self._ids, i)
+
+    def name(self, i):
+        return self._str(self._name_offsets, self._names, i)
+
+    def level(self, i):
+        return LEVELS[BYTE.unpack_from(self.buf, self._levels + i)[0]]
+
+    def status(self, i):
+        status = BYTE.unpack_from(self.buf, self._statuses + i)[0]
+        return None if status < 0 else STATUSES[status]
+
+    def node(self, i):
+        return Node(self.pk(i), self.id(i), self.name(i), self.level(i), self.status(i))
+
+    def index(self, pk):
+        """
+        :return: Index of the node for languoid pk or None.
+        """
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            i = self._int(self._by_pk, mid)
+            node_pk = self.pk(i)
+            if node_pk == pk:
+                return i
+            if node_pk < pk:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def ancestors(self, i):
+        """
+        :return: List of indices of the ancestors of node i, from father to top-level.
+        """
+        res = []
+        father = self.father(i)
+        while father is not None:
+            res.append(father)
+            father = self.father(father)
+        return res
+
+    def lineage(self, i):
+        """
+        :return: List of `Ancestor` tuples for the ancestors of node i.
+        """
+        return [
+            Ancestor(self.pk(j), self.id(j), self.name(j), self.level(j))
+            for j in self.ancestors(i)]
+
+    def descendants(self, i):
+        return range(i + 1, self.end(i))
+
+    def children(self, i):
+        child, end = i + 1, self.end(i)
+        while child < end:
+            yield child
+            child = self.end(child)
+
+
+class FamilyTree(object):
+    """
+    The nodes of the tree of a top-level family, as displayed with jqTree.
+
+    The nodes are shared by all pages of the family and must not be modified; page
+    specific attributes are added with `overlay`.
+    """
+    def __init__(self, items):
+        """
+        :param items: Iterable of (father_pk, pk, id, name, hid, level, status, \
+        child_language_count) tuples in depth-first order. Siblings are ordered by name.
+        """
+        self.nodes, self.fathers, children, keys = [], {}, {}, {}
+        for fpk, pk, id_, name, hid, level, status, clc in items:
+            keys[pk] = (name, pk)
+            if hid and len(hid) != 3:
+                hid = None
+            label = name
+            if clc:
+                label += ' (%s)' % clc
+            node = {
+                'id': id_,
+                'pk': pk,
+                'iso': hid,
+                'level': level,
+                'status': status,
+                'label': label,
+                'children': [],
+            }
+            children[pk] = node['children']
+            if not fpk:
+                self.nodes.append(node)
+            elif fpk in children:
+                self.fathers[pk] = fpk
+                children[fpk].append(node)
+            # else: dialects attached to inactive nodes are skipped.
+        # Tree edits number moved languoids after their new siblings, see
+        # `glottolog3.scripts.util.insert_intervals`.
+        for nodes in [self.nodes] + list(children.values()):
+            nodes.sort(key=lambda n: keys[n['pk']])
+        self._json = None
+
+    @classmethod
+    def from_db(cls, root_pk, session):
+        return cls(session.query(
+            Languoid.father_pk,
+            Languoid.pk,
+            Languoid.id,
+            Languoid.name,
+            Languoid.hid,
+            cast(Languoid.level, Text),
+            cast(Languoid.status, Text),
+            Languoid.child_language_count)
+            .filter(func.coalesce(Languoid.family_pk, Languoid.pk) == root_pk)
+            .order_by(Languoid.lft))
+
+    def overlay(self, attrs):
+        """
+        :param attrs: dict mapping pks of languoids to dicts of additional attributes.
+        :return: list of top-level nodes, with copies of the nodes with additional \
+        attributes and of their ancestors; all other nodes are shared.
+        """
+        copied = set()
+        for pk in attrs:
+            while pk is not None and pk not in copied:
+                copied.add(pk)
+                pk = self.fathers.get(pk)
+
+        def copy(nodes):
+            return [
+                dict(n, children=copy(n['children']), **attrs.get(n['pk'], {}))
+                if n['pk'] in copied else n for n in nodes]
+
+        return copy(self.nodes)
+
+    def json(self):
+        """
+        :return: The serialized nodes, computed once.
+        """
+        if self._json is None:
+            self._json = json.dumps(self.nodes, separators=(',', ':')).encode('utf8')
+        return self._json
+
+
+FAMILY_TREES = LRUCache(maxsize=500, ttl=3600)
+
+
+def get_family_tree(root_pk, session=None):
+    """
+    :param root_pk: pk of a top-level languoid.
+    :return: The FamilyTree, from the cache if the tree has not been edited since.
+    """
+    session = session or DBSession
+    generation = get_generation(TREE, session=session)
+    res = FAMILY_TREES.get(root_pk, generation)
+    if res is None:
+        res = FamilyTree.from_db(root_pk, session)
+        FAMILY_TREES.set(root_pk, res, generation)
+    return res
+
+
+def newick_label(id_, name, iso, level):
+    """
+    :return: The quoted Newick label of a languoid, formatted like the labels in the \
+    trees exported by pyglottolog.
+    """
+    label = '{0} [{1}]'.format(
+        name.replace(',', '/').replace('(', '{').replace(')', '}').replace("'", "''"),
+        id_)
+    if iso:
+        label += '[{0}]'.format(iso)
+    if level == LanguoidLevel.language:
+        label += '-l-'
+    return "'{0}'".format(label)
+
+
+def newick(items, depth=None, levels=None):
+    """
+    Serialize a tree in Newick format.
+
+    Nodes of levels not selected are left out; their selected descendants are attached to
+    the closest selected ancestor, with a branch length counting the edges in between.
+
+    :param items: Iterable of (pk, father_pk, id, name, iso, level) tuples in depth-first \
+    order, starting with the root, which is always included.
+    :param depth: Maximal number of edges between the root and included nodes or None.
+    :param levels: Collection of LanguoidLevel to include or None for all levels.
+    :return: The tree in Newick format, terminated by a semicolon.
+    """
+    items = iter(items)
+    root = next(items)
+    labels = {root[0]: newick_label(*root[2:])}
+    # pk of a node mapped to (its depth, pk of the closest included node on its lineage).
+    nodes = {root[0]: (0, root[0])}
+    children = {root[0]: []}
+    for pk, father_pk, id_, name, iso, level in items:
+        if father_pk not in nodes:
+            # descendants of inactive nodes or of nodes beyond depth are skipped.
+            continue
+        father_depth, anchor = nodes[father_pk]
+        if depth is not None and father_depth >= depth:
+            continue
+        if levels is None or level in levels:
+            labels[pk] = newick_label(id_, name, iso, level)
+            children[pk] = []
+            children[anchor].append((pk, father_depth + 1 - nodes[anchor][0]))
+            anchor = pk
+        nodes[pk] = (father_depth + 1, anchor)
+
+    def serialize(pk, length):
+        res = labels[pk] + ':{0}'.format(length)
+        if children[pk]:
+            res = '({0}){1}'.format(','.join(serialize(*c) for c in children[pk]), res)
+        return res
+
+    return serialize(root[0], 1) + ';'
+
+
+def nexus(id_, tree):
+    """
+    :return: A Newick tree wrapped in a Nexus TREES block.
+    """
+    return '#NEXUS\nBEGIN TREES;\n\tTREE {0} = [&R] {1}\nEND;\n'.format(id_, tree)
+
+
+def newick_options(params):
+    """
+    :param params: Request parameters `depth` and `level`, a comma separated list of \
+    levels.
+    :return: dict of keyword arguments for `get_newick`.
+    :raise ValueError: for invalid parameters.
+    """
+    res = {}
+    if params.get('depth'):
+        res['depth'] = int(params['depth'])
+        if res['depth'] < 0:
+            raise ValueError('depth must not be negative')
+    if params.get('level'):
+        res['levels'] = [
+            LanguoidLevel.from_string(l.strip()) for l in params['level'].split(',')]
+    return res
+
+
+NEWICK_TREES = LRUCache(maxsize=1000, ttl=3600)
+
+
+def get_newick(root, depth=None, levels=None, session=None):
+    """
+    :param root: Languoid at the root of the subtree.
+    :return: The subtree in Newick format (see `newick`), from the cache if neither the \
+    tree nor the identifiers have been edited since.
+    """
+    session = session or DBSession
+    levels = frozenset(levels) if levels is not None else None
+    key = (root.pk, depth, levels)
+    generation = (
+        get_generation(TREE, session=session), get_generation(SEARCH, session=session))
+    res = NEWICK_TREES.get(key, generation)
+    if res is None:
+        iso = session.query(Identifier.name)\
+            .filter(LanguageIdentifier.identifier_pk == Identifier.pk)\
+            .filter(LanguageIdentifier.language_pk == Languoid.pk)\
+            .filter(Identifier.type == IdentifierType.iso.value)\
+            .limit(1)\
+            .as_scalar()
+        res = newick(
+            session.query(
+                Languoid.pk,
+                Languoid.father_pk,
+                Languoid.id,
+                Languoid.name,
+                iso,
+                Languoid.level)
+            .filter(in_subtree(Languoid, root))
+            .filter(Language.active)
+            .order_by(Languoid.lft),
+            depth=depth,
+            levels=levels)
+        NEWICK_TREES.set(key, res, generation)
+    return res
+
+
+class LCAIndex(object):
+    """
+    Lowest common ancestors of languoids, looked up in constant time.
+
+    The tree is preprocessed into its Euler tour - the sequence of nodes visited by a
+    depth-first traversal - and a sparse table holding, for each position i and each k,
+    the shallowest node among the 2**k tour entries starting at i. The lowest common
+    ancestor of two nodes is the shallowest node on the tour between their first visits,
+    i.e. the minimum of two overlapping table entries.
+    """
+    def __init__(self, items):
+        """
+        :param items: Iterable of (pk, father_pk, glottocode, name, level, active) tuples.
+        """
+        items = list(items)
+        self.members = [Member(gc, name, level) for _, _, gc, name, level, _ in items]
+        self.index = {item[2]: i for i, item in enumerate(items) if item[5]}
+        pos = {item[0]: i for i, item in enumerate(items)}
+
+        # The top-level languoids are children of a virtual root, node n.
+        n = len(items)
+        children = [[] for _ in range(n + 1)]
+        for i, item in enumerate(items):
+            children[pos.get(item[1], n)].append(i)
+
+        self.depth = array('i', [0] * (n + 1))
+        self.first = array('i', [0] * (n + 1))
+        tour = array('i')
+        stack = [(n, 0)]
+        while stack:
+            node, next_child = stack.pop()
+            if next_child == 0:
+                self.first[node] = len(tour)
+            tour.append(node)
+            if next_child < len(children[node]):
+                child = children[node][next_child]
+                self.depth[child] = self.depth[node] + 1
+                stack.append((node, next_child + 1))
+                stack.append((child, 0))
+
+        depth = self.depth
+        self.table = [tour]
+        k = 1
+        while 2 ** k <= len(tour):
+            prev, half = self.table[-1], 2 ** (k - 1)
+            self.table.append(array('i', [
+                a if depth[a] <= depth[b] else b for a, b in zip(prev, prev[half:])]))
+            k += 1
+
+    @classmethod
+    def from_db(cls, session):
+        return cls(session.query(
+            Languoid.pk,
+            Languoid.father_pk,
+            Languoid.id,
+            Languoid.name,
+            Languoid.level,
+            Language.active))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, glottocode):
+        return glottocode in self.index
+
+    def _lca(self, i, j):
+        lo, hi = sorted([self.first[i], self.first[j]])
+        k = (hi - lo + 1).bit_length() - 1
+        a, b = self.table[k][lo], self.table[k][hi - 2 ** k + 1]
+        return a if self.depth[a] <= self.depth[b] else b
+
+    def relation(self, a, b):
+        """
+        :param a: glottocode of an active languoid.
+        :param b: glottocode of an active languoid.
+        :return: Relation with the lowest common ancestor as Member and the number of \
+        edges on the path between a and b; both None if a and b are in different trees.
+        :raise KeyError: if a or b is not the glottocode of an active languoid.
+        """
+        i, j = self.index[a], self.index[b]
+        lca = self._lca(i, j)
+        if lca == len(self.members):
+            return Relation(None, None)
+        return Relation(
+            self.members[lca], self.depth[i] + self.depth[j] - 2 * self.depth[lca])
+
+
+def pack(generation, rows):
+    """
+    Serialize a tree.
+
+    :param rows: (pk, father_pk, id, name, level, status, lft, rgt) tuples of the \
+    languoids, ordered by top-level family and lft.
+    :return: The snapshot as bytes.
+    """
+    rows = list(rows)
+    index = {row[0]: i for i, row in enumerate(rows)}
+    pks, fathers, ends = array('i'), array('i'), array('i')
+    levels, statuses = array('b'), array('b')
+    id_offsets, name_offsets = array('i', [0]), array('i', [0])
+    ids, names = bytearray(), bytearray()
+    for i, (pk, father_pk, id_, name, level, status, lft, rgt) in enumerate(rows):
+        pks.append(pk)
+        fathers.append(-1 if father_pk is None else index[father_pk])
+        # an interval (lft, rgt) spans (rgt - lft - 1) / 2 descendants.
+        ends.append(i + 1 + (rgt - lft - 1) // 2)
+        levels.append(LEVELS.index(level))
+        statuses.append(-1 if status is None else STATUSES.index(status))
+        ids.extend(id_.encode('utf8'))
+        id_offsets.append(len(ids))
+        names.extend(name.encode('utf8'))
+        name_offsets.append(len(names))
+    by_pk = array('i', sorted(range(len(rows)), key=lambda i: pks[i]))
+
+    res = [HEADER.pack(MAGIC, generation, len(rows), len(ids), len(names))]
+    for a in [pks, fathers, ends, by_pk, id_offsets, name_offsets, levels, statuses]:
+        if sys.byteorder == 'big':
+            a.byteswap()
+        res.append(a.tobytes() if hasattr(a, 'tobytes') else a.tostring())
+    res.extend([bytes(ids), bytes(names)])
+    return b''.join(res)
+
+
+def write(path=None, session=None):
+    """
+    Write a snapshot of the current tree, tagged with a new generation of the tree.
+
+    The file is replaced atomically, i.e. workers still mapping the old file are not
+    affected until they reload.
+    """
+    session = session or DBSession
+    path = path or snapshot_path(session)
+    bump_generation(TREE, session=session)
+    generation = get_generation(TREE, session=session)
+
+    rows = session.query(
+        Languoid.pk,
+        Languoid.father_pk,
+        Languoid.id,
+        Languoid.name,
+        Languoid.level,
+        Languoid.status,
+        Languoid.lft,
+        Languoid.rgt)\
+        .order_by(func.coalesce(Languoid.family_pk, Languoid.pk), Languoid.lft)\
+        .all()
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    with os.fdopen(fd, 'wb') as fp:
+        fp.write(pack(generation, rows))
+    os.chmod(tmp, 0o644)
+    os.rename(tmp, path)
+    return path
+
+
+def load(session=None):
+    """
+    :return: TreeSnapshot mapping the snapshot file, if it is up to date, else None.
+    """
+    session = session or DBSession
+    try:
+        with open(snapshot_path(session), 'rb') as fp:
+            snapshot = TreeSnapshot(mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ))
+    except (IOError, OSError, ValueError, struct.error):
+        return None
+    if snapshot.generation != get_generation(TREE, session=session):
+        return None
+    return snapshot
+
+
+SNAPSHOT = DerivedData(load, TREE)
+
+
+def get_snapshot(session=None):
+    """
+    :return: The current TreeSnapshot or None, if there is no up-to-date snapshot.
+    """
+    return SNAPSHOT.get(session=session)
@@ -1,8 +1,11 @@
 from __future__ import unicode_literals
 import re
+import json
+import base64
 from itertools import cycle
 
 from purl import URL
+from sqlalchemy import or_
 import colander
 from markdown import markdown
 from markupsafe import Markup
@@ -21,7 +24,7 @@ from pyglottolog.languoids import Reference
 
 from glottolog3.models import (
     Languoid, Provider, Ref, Refprovider,
-    Macroarea, Refmacroarea, TreeClosureTable, Doctype, Refdoctype,
+    Macroarea, Refmacroarea, Doctype, Refdoctype, in_subtree,
 )
 from glottolog3.maps import LanguoidMap
 
@@ -30,6 +33,29 @@ LANG_PATTERN = re.compile('\[(?P<id>[^\]]+)\]')
 ISO_PATTERN = re.compile(r'\[(?P<iso>[a-z]{3})\]')
 
 
+def encode_cursor(values):
+    """
+    :return: Opaque, URL-safe token for the sort key of the last item of a result page.
+    """
+    return base64.urlsafe_b64encode(
+        json.dumps(values, separators=(',', ':')).encode('utf8')).decode('ascii')
+
+
+def decode_cursor(cursor, length):
+    """
+    :return: list of sort key values encoded with `encode_cursor`.
+    :raises ValueError: if cursor is not a valid token for a sort key of the given length.
+    """
+    try:
+        values = json.loads(
+            base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf8'))
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor')
+    if not isinstance(values, list) or len(values) != length:
+        raise ValueError('Invalid cursor')
+    return values
+
+
 def set_focus(url, focus):
     return URL(url).query_param('focus', focus).as_string()
 
@@ -177,10 +203,8 @@ def getRefs(params):
     if params.get('languoids'):
         filtered = True
         subquery = DBSession.query(LanguageSource).filter_by(source_pk=Ref.pk)\
-            .join(TreeClosureTable,
-                TreeClosureTable.child_pk == LanguageSource.language_pk)\
-            .filter(TreeClosureTable.parent_pk.in_(
-                [l.pk for l in params['languoids']]))
+            .join(Languoid, Languoid.pk == LanguageSource.language_pk)\
+            .filter(or_(*[in_subtree(Languoid, l) for l in params['languoids']]))
         query = query.filter(subquery.exists())
 
     if params.get('doctypes'):
@@ -346,12 +370,20 @@ def format_external_link_in_label(url, label=None):
         class_="label label-info")
 
 
-def get_map(request, context):
+def get_icon_map(request, context):
+    """
+    :return: dict mapping the pks of a languoid and its children to map marker URLs.
+    """
     icon_map = dict(
         zip([context.pk] + [l.pk for l in context.children],
             cycle([s + c for s in SHAPES for c in COLORS])))
     for key in icon_map:
         icon_map[key] = request.registry.getUtility(IIcon, icon_map[key]).url(request)
+    return icon_map
+
+
+def get_map(request, context):
+    icon_map = get_icon_map(request, context)
     return dict(icon_map=icon_map, lmap=LanguoidMap(context, request, icon_map=icon_map))
 
 
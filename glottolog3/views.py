@@ -1,109 +1,316 @@
+import hashlib
 import json
-import transaction
 from collections import OrderedDict
-from itertools import groupby
-from unidecode import unidecode
+from itertools import islice
+
+import transaction
 
 from marshmallow import ValidationError
 from pyramid.httpexceptions import (
     HTTPNotAcceptable, HTTPNotFound, HTTPFound, HTTPMovedPermanently,
 )
 from pyramid.view import view_config
-from sqlalchemy import and_, true, false, null, or_, exc
-from sqlalchemy.sql.expression import func
-from sqlalchemy.orm import joinedload
+from sqlalchemy import and_, true, false, null, or_, exc, literal, tuple_
+from sqlalchemy.orm import Session
 from clld.db.meta import DBSession
 from clld.db.models.common import (
     Language, LanguageIdentifier, Identifier, IdentifierType,
 )
+from clld.interfaces import IMapMarker
+from clld.web.adapters.geojson import get_feature, get_lonlat
 
 from glottolog3.models import (
-    Languoid, LanguoidSchema, LanguoidStatus, LanguoidLevel, Macroarea, Doctype,
-    IdentifierSchema, Refprovider, TreeClosureTable, BOOKKEEPING,
+    Languoid, LanguoidSchema, LanguoidDocument, LanguoidStatus, LanguoidLevel,
+    Macroarea, Doctype, IdentifierSchema, Refprovider, BOOKKEEPING, MapLayer,
+    in_subtree,
 )
 from glottolog3.models import GLOTTOCODE_PATTERN
+from glottolog3.util import encode_cursor, decode_cursor, get_icon_map
+from glottolog3.maps import LanguoidGeoJson
+from glottolog3.scripts.util import (
+    move_languoid, move_languoids, update_level_counts, rename_in_lineages,
+    recreate_intervals, recreate_lineages, recreate_map_layers,
+)
+from glottolog3.cache import (
+    LRUCache, DerivedData, Generation, SEARCH, TREE, GEO, get_generation,
+    bump_generation,
+)
+from glottolog3 import search
+from glottolog3 import tree
+from glottolog3 import geo
+
+# Search responses keyed by normalized request parameters.
+SEARCH_CACHE = LRUCache(maxsize=5000, ttl=600)
+SEARCH_GENERATION = Generation(SEARCH)
+# Identifier names for autocompletion.
+PREFIX_INDEX = DerivedData(search.PrefixIndex.from_db, SEARCH)
+# Code identifiers for exact lookup.
+CODE_INDEX = DerivedData(search.CodeIndex.from_db, SEARCH)
+
+# Minimal length of search terms.
+MIN_QUERY_LEN = 3
+# Default and maximal number of descendants per page.
+DESCENDANTS_LIMIT = 100
+MAX_DESCENDANTS_LIMIT = 1000
+# Maximal number of languoids fetched with one request.
+MAX_LANGUOIDS = 1000
+
+LCA_INDEX = DerivedData(tree.LCAIndex.from_db, TREE)
+MAX_PAIRS = 10000
+
+MAX_CLASSIFICATIONS = 10000
+
+# Geocoded languages for the tiles of the languages map.
+TILE_GRID = DerivedData(geo.TileGrid.from_db, GEO)
+# Geocoded languoids for bounding box and nearest neighbour queries.
+SPATIAL_INDEX = DerivedData(geo.SpatialIndex.from_db, GEO)
+SPATIAL_FIELDS = ['id', 'name', 'level', 'latitude', 'longitude']
+# Default and maximal number of languoids in a bounding box, default number of neighbours.
+SPATIAL_LIMIT = 1000
+MAX_SPATIAL_LIMIT = 10000
+NEAR_LIMIT = 10
+
+# Attributes of languoids held by the data depending on a generation; moves bump the
+# generations themselves.
+GENERATION_FIELDS = [
+    (SEARCH, {'id', 'name', 'hid', 'level', 'active'}),
+    (TREE, {'id', 'name', 'hid', 'level', 'status', 'active'}),
+    (GEO, {'id', 'name', 'level', 'latitude', 'longitude', 'active'}),
+]
 
 # ENDPOINTS ADDED BY BLUEPRINT
-def identifier_score(identifier, term):
-    # sorting key method that will return a lower rank for greater similarity
-    lower_id = unidecode(identifier.lower())
-    coverage = float(len(term))/len(lower_id)
-    if lower_id == term:
-        return 0
-    elif lower_id.startswith(term):
-        return 1 - coverage
-    elif ' ' + term in lower_id:
-        return 2 - coverage
-    return 3 - coverage
-
-def best_identifier_score(identifiers, term):
-    rank = 3
-    for i in identifiers:
-        rank = min(rank,identifier_score(i.Identifier.name,term))
-    return rank
-
 @view_config(
         route_name='glottolog.search',
         request_method='GET',
         renderer='json')
 def bp_api_search(request):
-    query = DBSession.query(Languoid, LanguageIdentifier, Identifier).join(LanguageIdentifier).join(Identifier)
-    term = request.params['q'].strip().lower()
-    whole = request.params.get('whole', "False")
-    multilingual = request.params.get('multilingual', "True")
+    term = search.normalize(request.params['q'])
+    whole = request.params.get('whole', "False").lower() == 'true'
+    multilingual = request.params.get('multilingual', "True").lower() != 'false'
+    fuzzy = request.params.get('fuzzy', "False").lower() == 'true'
 
-    MIN_QUERY_LEN = 3
+    try:
+        limit = int_param(request, 'limit', search.LIMIT, search.MAX_LIMIT)
+        cursor = request.params.get('cursor')
+        after = decode_cursor(cursor, 3) if cursor else None
+    except ValueError as e:
+        request.response.status = 400
+        return {'error': '{}'.format(e)}
 
     if not term:
-        query = None
+        return []
     elif len(term) < MIN_QUERY_LEN:
         return [{'message': 'Query must be at least {} characters.'.format(MIN_QUERY_LEN)}]
-    elif len(term) == 8 and GLOTTOCODE_PATTERN.match(term):
-        query = query.filter(Languoid.id == term)
-        kind = 'Glottocode'
+
+    key = (term, whole, multilingual, fuzzy, limit, cursor)
+    generation = SEARCH_GENERATION.get()
+    page = SEARCH_CACHE.get(key, generation)
+    if page is None:
+        page = search_page(term, whole, multilingual, fuzzy, limit, after)
+        SEARCH_CACHE.set(key, page, generation)
+
+    results, next_cursor = page
+    if next_cursor:
+        set_next_link(request, next_cursor)
+    return results
+
+
+def search_page(term, whole, multilingual, fuzzy, limit, after):
+    """
+    :return: pair (list of result dicts, cursor for the next page or None)
+    """
+    if len(term) == 8 and GLOTTOCODE_PATTERN.match(term):
+        if after:
+            return [], None
+        results = DBSession.query(
+            Languoid.id, Languoid.name, Languoid.hid, Languoid.level,
+            literal(None).label('identifiers'), literal(0.0).label('score'))\
+            .select_from(Languoid)\
+            .filter(Languoid.id == term)\
+            .all()
     else:
-        # list of criteria to search languoids by
-        filters = []
-        filters.append(Language.active == True)
-        ul_iname = func.unaccent(func.lower(Identifier.name))
-        ul_name = func.unaccent(term)
-        if whole.lower() == 'true':
-            filters.append(ul_iname == ul_name)
-        else:
-            filters.append(ul_iname.contains(ul_name))
-        if multilingual.lower() == 'false':
-            # restrict to English identifiers
-            filters.append(func.coalesce(Identifier.lang, '').in_((u'', u'eng', u'en')))
+        # exact matches of code identifiers come first, ...
+        codes = CODE_INDEX.get().lookup(term)
+        hits = [hit for hit in codes
+                if not after or (hit.score, hit.name, hit.id) > tuple(after)]
+        # ... followed by languoids ordered by greatest identifier similarity, and then
+        # by name to break ties + consistency. We fetch one more than requested to know
+        # whether there is a next page.
+        results = hits + search.ranked_languoids(
+            term,
+            whole=whole,
+            multilingual=multilingual,
+            fuzzy=fuzzy,
+            limit=limit + 1,
+            after=after,
+            exclude=[hit.id for hit in codes]).all()
+
+    next_cursor = None
+    if len(results) > limit:
+        results = results[:limit]
+        last = results[-1]
+        next_cursor = encode_cursor([last.score, last.name, last.id])
+
+    return [search_result(row) for row in results], next_cursor
+
+
+def search_result(row):
+    return {
+        'name': row.name,
+        'glottocode': row.id,
+        'iso': row.hid if row.hid else '',
+        'level': row.level.name,
+        'matched_identifiers': row.identifiers or [],
+    }
 
-        query = query.filter(and_(*filters))
-        kind = 'name part'
 
-    if query is None:
-        return []
-    else:
-        results = query.order_by(Languoid.name)\
-                .options(joinedload(Languoid.family)).all()
-        if not results:
-            return []
-
-    # group together identifiers that matched for the same languoid
-    mapped_results = {k:list(g) for k, g in groupby(results, lambda x: x.Languoid)}
-    # order languoid results by greatest identifier similarity, and then by name to break ties + consistency
-    ordered_results = OrderedDict(sorted(
-        mapped_results.items(),
-        key=lambda x: (best_identifier_score(x[1],term), x[0].name)
-    ))
-
-    return [{
-        'name': k.name,
-        'glottocode': k.id,
-        'iso': k.hid if k.hid else '',
-        'level': k.level.name,
-        'matched_identifiers': sorted(
-            set([i.Identifier.name for i in v]),
-            key=lambda x: identifier_score(x, term)
-        )  if kind != 'Glottocode' else [],
-        } for k, v in ordered_results.items()]
+@view_config(
+        route_name='glottolog.search_batch',
+        request_method='POST',
+        renderer='json')
+def search_batch(request):
+    """
+    Search for many terms at once.
+
+    The payload is an object with a list of `terms`, each either a string or an object
+    with the search term as `q` and any of the options `whole`, `multilingual`, `fuzzy`
+    and `limit`. Options given at the top level of the payload serve as defaults.
+
+    Results are returned as list of {q, results} objects in the order of the terms, or -
+    for large batches - streamed as newline-delimited JSON if requested via `stream=true`
+    or an `Accept: application/x-ndjson` header.
+    """
+    try:
+        terms = batch_terms(request.json_body)
+    except ValueError as e:
+        request.response.status = 400
+        return {'error': '{}'.format(e)}
+
+    if request.params.get('stream', 'false').lower() == 'true' \
+            or 'application/x-ndjson' in request.headers.get('Accept', ''):
+        response = request.response
+        response.content_type = 'application/x-ndjson'
+        response.app_iter = stream_batch(terms, DBSession.get_bind())
+        return response
+
+    return list(batch_results(terms))
+
+
+def batch_results(terms, session=None):
+    """
+    :return: Generator of {q, results} dicts, one per term.
+    """
+    searchable = [t for t in terms if len(t[0]) >= MIN_QUERY_LEN]
+    results = search.batch_search(
+        searchable, codes=CODE_INDEX.get(session=session), session=session)
+    for t in terms:
+        yield {
+            'q': t[5],
+            'results': [search_result(row) for row in next(results)]
+            if len(t[0]) >= MIN_QUERY_LEN else [],
+        }
+
+
+def stream_batch(terms, bind):
+    """
+    Serialize batch search results lazily.
+
+    The iterator is consumed after the request transaction has ended, so it uses a session
+    of its own.
+    """
+    session = Session(bind=bind)
+    try:
+        for result in batch_results(terms, session=session):
+            yield (json.dumps(result) + '\n').encode('utf8')
+    finally:
+        session.close()
+
+
+def batch_terms(payload):
+    """
+    :return: list of (term, whole, multilingual, fuzzy, limit, q) tuples, where q is the \
+    term as sent.
+    """
+    if not isinstance(payload, dict) or not isinstance(payload.get('terms'), list):
+        raise ValueError('Payload must be an object with a list of terms')
+    if len(payload['terms']) > search.MAX_BATCH:
+        raise ValueError('At most {0} terms can be searched at once'.format(search.MAX_BATCH))
+
+    res = []
+    for spec in payload['terms']:
+        if not isinstance(spec, dict):
+            spec = {'q': spec}
+        options = dict(payload, **spec)
+        term = '{0}'.format(spec.get('q') or '').strip().lower()
+        try:
+            limit = int(options.get('limit', search.BATCH_LIMIT))
+        except (TypeError, ValueError):
+            raise ValueError('limit must be an integer')
+        if limit < 1:
+            raise ValueError('limit must be positive')
+        res.append((
+            term,
+            bool_option(options, 'whole', False),
+            bool_option(options, 'multilingual', True),
+            bool_option(options, 'fuzzy', False),
+            min(limit, search.MAX_LIMIT),
+            spec.get('q')))
+    return res
+
+
+def bool_option(options, name, default):
+    value = options.get(name, default)
+    if not isinstance(value, bool):
+        raise ValueError('{0} must be true or false'.format(name))
+    return value
+
+
+@view_config(
+        route_name='glottolog.search_suggest',
+        request_method='GET',
+        renderer='json')
+def search_suggest(request):
+    try:
+        limit = int_param(
+            request, 'limit', search.SUGGEST_LIMIT, search.MAX_SUGGEST_LIMIT)
+    except ValueError as e:
+        request.response.status = 400
+        return {'error': '{}'.format(e)}
+
+    return [
+        {'name': name, 'glottocode': gc} for name, gc in
+        PREFIX_INDEX.get().complete(request.params.get('q', ''), limit=limit)]
+
+
+@view_config(
+        route_name='glottolog.search_cache',
+        request_method='GET',
+        renderer='json')
+def search_cache_stats(request):
+    return SEARCH_CACHE.stats()
+
+
+def int_param(request, name, default, maximum):
+    """
+    :return: Positive integer value of a request parameter, capped at maximum.
+    """
+    try:
+        value = int(request.params.get(name, default))
+    except ValueError:
+        raise ValueError('{0} must be an integer'.format(name))
+    if value < 1:
+        raise ValueError('{0} must be positive'.format(name))
+    return min(value, maximum)
+
+
+def set_next_link(request, cursor):
+    """
+    Signal that more results exist, by linking to the next page of results.
+    """
+    params = dict(request.params)
+    params['cursor'] = cursor
+    request.response.headers['Link'] = '<{0}>; rel="next"'.format(
+        request.current_route_url(_query=params))
 
 
 @view_config(
@@ -132,9 +339,11 @@ def add_identifier(request):
 
     try:
         DBSession.add(identifier)
+        search.index_identifier(identifier)
         DBSession.add(
             LanguageIdentifier(language=languoid, identifier=identifier))
         DBSession.flush()
+        bump_generation(SEARCH)
         result = json.dumps(IdentifierSchema().dump(identifier))
     except exc.SQLAlchemyError as e:
         request.response.status = 400
@@ -214,8 +423,10 @@ def put_identifier(request):
         for key in new_identifier:
             # Cannot direct lookup on identifier object
             setattr(identifier, key, getattr(data, key))
+        search.index_identifier(identifier)
 
         DBSession.flush()
+        bump_generation(SEARCH)
         result = json.dumps(IdentifierSchema().dump(identifier))
     except exc.SQLAlchemyError as e:
         request.response.status = 400
@@ -244,6 +455,7 @@ def delete_identifier(request):
                  .delete()
         id_query.delete()
         DBSession.flush()
+        bump_generation(SEARCH)
     except exc.SQLAlchemyError as e:
         request.response.status = 400
         DBSession.rollback()
@@ -267,12 +479,404 @@ def query_languoid(DBSession, id):
     route_name='glottolog.get_languoid',
     renderer='json')
 def get_languoid(request):
-    glottocode = request.matchdict['glottocode']
-    languoid = query_languoid(DBSession, glottocode)
+    try:
+        fields = fields_param(request)
+    except ValueError as e:
+        request.response.status = 400
+        return {'error': '{}'.format(e)}
+
+    languoid = LanguoidDocument.get(request.matchdict['glottocode'], fields=fields)
     if languoid is None:
         request.response.status = 404
         return {'error': 'Not a valid languoid ID'}
-    return LanguoidSchema().dump(languoid).data
+    return LanguoidSchema(only=fields).dump(languoid).data
+
+
+def fields_param(request):
+    """
+    :return: list of the LanguoidSchema fields selected with the `fields` parameter, or \
+    None if all fields are requested.
+    """
+    fields = [f.strip() for f in request.params.get('fields', '').split(',') if f.strip()]
+    if not fields:
+        return None
+    valid = [name for name, field in LanguoidSchema().fields.items() if not field.load_only]
+    unknown = [f for f in fields if f not in valid]
+    if unknown:
+        raise ValueError('Invalid fields: {0}'.format(', '.join(unknown)))
+    return fields
+
+
+@view_config(
+    route_name='glottolog.get_languoids',
+    renderer='json')
+def get_languoids(request):
+    """
+    Many languoid documents at once.
+
+    Glottocodes are passed as comma-separated `ids` parameter or - via POST - as list `ids`
+    in a JSON object. Documents are returned in request order, glottocodes of unknown
+    languoids are listed as `missing`.
+    """
+    try:
+        fields = fields_param(request)
+        if request.method == 'POST':
+            payload = request.json_body
+            ids = payload.get('ids') if isinstance(payload, dict) else None
+            if not isinstance(ids, list):
+                raise ValueError('Payload must be an object with a list of ids')
+            ids = ['{0}'.format(gc).strip() for gc in ids]
+        else:
+            ids = [gc.strip() for gc in request.params.get('ids', '').split(',')]
+        ids = [gc for gc in OrderedDict((gc, 1) for gc in ids if gc)]
+        if len(ids) > MAX_LANGUOIDS:
+            raise ValueError('At most {0} languoids can be fetched at once'.format(
+                MAX_LANGUOIDS))
+    except ValueError as e:
+        request.response.status = 400
+        return {'error': '{}'.format(e)}
+
+    documents = LanguoidDocument.get_many(ids, fields=fields)
+    schema = LanguoidSchema(only=fields)
+    return {
+        'languoids': [schema.dump(documents[gc]).data for gc in ids if gc in documents],
+        'missing': [gc for gc in ids if gc not in documents],
+    }
+
+
+@view_config(
+    route_name='glottolog.get_descendants',
+    renderer='json')
+def get_descendants(request):
+    """
+    All descendants of a languoid, ordered by name and paged by cursor.
+    """
+    try:
+        limit = int_param(request, 'limit', DESCENDANTS_LIMIT, MAX_DESCENDANTS_LIMIT)
+        cursor = request.params.get('cursor')
+        after = decode_cursor(cursor, 2) if cursor else None
+    except ValueError as e:
+        request.response.status = 400
+        return {'error': '{}'.format(e)}
+
+    languoid = query_languoid(DBSession, request.matchdict['glottocode'])
+    if languoid is None:
+        request.response.status = 404
+        return {'error': 'Not a valid languoid ID'}
+
+    query = DBSession.query(Languoid.id, Languoid.name, Languoid.level)\
+        .filter(in_subtree(Languoid, languoid, proper=True))
+    if after:
+        query = query.filter(tuple_(Languoid.name, Languoid.id) > tuple_(*after))
+    descendants = query.order_by(Languoid.name, Languoid.id).limit(limit + 1).all()
+
+    if len(descendants) > limit:
+        descendants = descendants[:limit]
+        set_next_link(request, encode_cursor(
+            [descendants[-1].name, descendants[-1].id]))
+    return LanguoidSchema(many=True, only=['id', 'name', 'level']).dump(descendants).data
+
+
+@view_config(
+    route_name='glottolog.get_tree',
+    renderer='json')
+def get_tree(request):
+    """
+    The tree of the top-level family of a languoid as nodes for jqTree.
+
+    All languoids of a family share the tree, which changes only with edits of the tree, so
+    responses carry an ETag and conditional requests are answered with 304 Not Modified.
+    """
+    languoid = query_languoid(DBSession, request.matchdict['glottocode'])
+    if languoid is None:
+        request.response.status = 404
+        return {'error': 'Not a valid languoid ID'}
+
+    root_pk = languoid.family_pk or languoid.pk
+    response = request.response
+    response.etag = 'tree-{0}-{1}'.format(root_pk, get_generation(TREE))
+    response.cache_control = 'no-cache'
+    if response.etag in request.if_none_match:
+        response.status = 304
+        return response
+    response.content_type = 'application/json'
+    response.body = tree.get_family_tree(root_pk).json()
+    return response
+
+
+@view_config(
+    route_name='glottolog.get_newick',
+    renderer='json')
+def get_newick(request):
+    """
+    The subtree rooted at a languoid in Newick format, or wrapped in a Nexus file with
+    parameter format=nexus. The subtree can be limited with parameters `depth` - the
+    maximal number of edges below the languoid - and `level` - a comma separated list of
+    the levels to include.
+    """
+    languoid = query_languoid(DBSession, request.matchdict['glottocode'])
+    if languoid is None:
+        request.response.status = 404
+        return {'error': 'Not a valid languoid ID'}
+
+    fmt = request.params.get('format', 'newick')
+    if fmt not in ('newick', 'nexus'):
+        request.response.status = 400
+        return {'error': 'format must be newick or nexus'}
+    try:
+        options = tree.newick_options(request.params)
+    except ValueError as e:
+        request.response.status = 400
+        return {'error': '{}'.format(e)}
+
+    res = tree.get_newick(languoid, **options)
+    response = request.response
+    response.content_type = 'text/plain'
+    response.charset = 'utf-8'
+    response.text = tree.nexus(languoid.id, res) if fmt == 'nexus' else res
+    return response
+
+
+@view_config(
+    route_name='glottolog.language_tiles',
+    renderer='json')
+def language_tiles(request):
+    """
+    The geocoded languages in a map tile as GeoJSON feature collection.
+
+    Tiles are addressed as in slippy maps. At low zoom levels, nearby languages are merged
+    into features with properties `cluster` and `count` (see `glottolog3.geo`).
+    """
+    try:
+        z, x, y = [int(request.matchdict[k]) for k in 'zxy']
+        grid, generation = TILE_GRID.get_versioned()
+        features = grid.tile(z, x, y)
+    except ValueError as e:
+        request.response.status = 400
+        return {'error': '{}'.format(e)}
+
+    response = request.response
+    # the response depends on the grid served and the query parameters.
+    params = json.dumps(sorted(request.params.items()))
+    response.etag = 'tile-{0}-{1}'.format(
+        generation, hashlib.md5(params.encode('utf8')).hexdigest())
+    response.cache_control = 'no-cache'
+    if response.etag in request.if_none_match:
+        response.status = 304
+        return response
+
+    marker = request.registry.getUtility(IMapMarker)
+    response.content_type = 'application/json'
+    response.text = json.dumps({
+        'type': 'FeatureCollection',
+        'properties': {'layer': request.params.get('layer', '')},
+        'features': [tile_feature(f, marker, request) for f in features],
+    })
+    return response
+
+
+@view_config(
+    route_name='glottolog.bbox',
+    renderer='json')
+def bbox(request):
+    """
+    Geocoded languoids within the box given as parameter bbox=west,south,east,north, in
+    order of longitude. Boxes with west > east span the antimeridian.
+    """
+    try:
+        box = request.params.get('bbox', '').split(',')
+        if len(box) != 4:
+            raise ValueError('bbox must be given as west,south,east,north')
+        west, south = coordinates(*box[:2])
+        east, north = coordinates(*box[2:])
+        levels = levels_param(request)
+        limit = int_param(request, 'limit', SPATIAL_LIMIT, MAX_SPATIAL_LIMIT)
+    except ValueError as e:
+        request.response.status = 400
+        return {'error': '{}'.format(e)}
+
+    languoids = islice(
+        SPATIAL_INDEX.get().bbox(west, south, east, north, levels=levels), limit)
+    return LanguoidSchema(many=True, only=SPATIAL_FIELDS).dump(list(languoids)).data
+
+
+@view_config(
+    route_name='glottolog.near',
+    renderer='json')
+def near(request):
+    """
+    The k nearest geocoded languoids to the point given as parameters lat and lon, with
+    their great-circle distance in km.
+    """
+    try:
+        longitude, latitude = coordinates(
+            request.params.get('lon'), request.params.get('lat'))
+        levels = levels_param(request)
+        k = int_param(request, 'k', NEAR_LIMIT, MAX_LANGUOIDS)
+    except ValueError as e:
+        request.response.status = 400
+        return {'error': '{}'.format(e)}
+
+    res, schema = [], LanguoidSchema(only=SPATIAL_FIELDS)
+    for languoid, distance in SPATIAL_INDEX.get().near(longitude, latitude, k, levels):
+        item = schema.dump(languoid).data
+        item['distance'] = round(distance, 3)
+        res.append(item)
+    return res
+
+
+def coordinates(longitude, latitude):
+    """
+    :return: pair of floats (longitude, latitude).
+    :raise ValueError: for missing or invalid coordinates.
+    """
+    try:
+        res = float(longitude), float(latitude)
+    except (TypeError, ValueError):
+        raise ValueError('invalid coordinates {0},{1}'.format(longitude, latitude))
+    if not -180 <= res[0] <= 180 or not -90 <= res[1] <= 90:
+        raise ValueError('coordinates out of range {0},{1}'.format(*res))
+    return res
+
+
+def levels_param(request):
+    """
+    :return: list of LanguoidLevel passed as comma-separated `level` parameter, languages \
+    by default.
+    """
+    return [LanguoidLevel.from_string(l.strip())
+            for l in request.params.get('level', 'language').split(',')]
+
+
+@view_config(
+    route_name='glottolog.map_layer',
+    renderer='json')
+def map_layer(request):
+    """
+    The layer of the map of a languoid as GeoJSON.
+
+    The layer is read from the precomputed MapLayer if there is one. Requests for its
+    current version - i.e. with its hash as parameter v - may be cached for a year, since
+    other versions have other URLs.
+    """
+    languoid = Languoid.get(request.matchdict['glottocode'], default=None)
+    if languoid is None:
+        request.response.status = 404
+        return {'error': 'Not a valid languoid ID'}
+
+    layer = DBSession.query(MapLayer).filter(MapLayer.languoid_pk == languoid.pk).first()
+    response = request.response
+    if layer and request.params.get('v') == layer.hash:
+        response.cache_control = 'public, max-age=31536000, immutable'
+    else:
+        response.cache_control = 'no-cache'
+    geojson = LanguoidGeoJson(
+        languoid,
+        get_icon_map(request, languoid),
+        geocoords=layer.geocoords if layer else None)
+    response.content_type = 'application/json'
+    response.text = geojson.render(languoid, request)
+    return response
+
+
+def tile_feature(item, marker, request):
+    lonlat = get_lonlat((item.longitude, item.latitude))
+    if isinstance(item, geo.Cluster):
+        return get_feature(item, lonlat=lonlat, cluster=True, count=item.count)
+    return get_feature(
+        item,
+        lonlat=lonlat,
+        icon=marker(item, request),
+        language={
+            'id': item.id,
+            'pk': item.pk,
+            'name': item.name,
+            'latitude': item.latitude,
+            'longitude': item.longitude,
+            'family_pk': item.family_pk,
+        },
+        family={'id': item.family_id, 'name': item.family_name}
+        if item.family_pk else None)
+
+
+@view_config(
+    route_name='glottolog.get_lca',
+    renderer='json')
+def get_lca(request):
+    """
+    Lowest common ancestor of two languoids and their distance in the tree.
+    """
+    glottocodes = request.matchdict['glottocode'], request.matchdict['other']
+    res = relation(LCA_INDEX.get(), *glottocodes)
+    if 'error' in res:
+        request.response.status = 404
+    return res
+
+
+@view_config(
+    route_name='glottolog.lca_batch',
+    request_method='POST',
+    renderer='json')
+def lca_batch(request):
+    """
+    Lowest common ancestors for many pairs of languoids, passed as list `pairs` of
+    glottocode pairs in a JSON object.
+    """
+    payload = request.json_body
+    pairs = payload.get('pairs') if isinstance(payload, dict) else None
+    if not isinstance(pairs, list) or \
+            not all(isinstance(p, list) and len(p) == 2 for p in pairs):
+        request.response.status = 400
+        return {'error': 'Payload must be an object with a list of glottocode pairs'}
+    if len(pairs) > MAX_PAIRS:
+        request.response.status = 400
+        return {'error': 'At most {0} pairs can be queried at once'.format(MAX_PAIRS)}
+
+    index = LCA_INDEX.get()
+    return [relation(index, '{0}'.format(a), '{0}'.format(b)) for a, b in pairs]
+
+
+def relation(index, a, b):
+    missing = [gc for gc in (a, b) if gc not in index]
+    if missing:
+        return {'a': a, 'b': b, 'error': 'Not a valid languoid ID: {0}'.format(missing[0])}
+    lca, distance = index.relation(a, b)
+    return {
+        'a': a,
+        'b': b,
+        'lca': LanguoidSchema(only=['id', 'name', 'level']).dump(lca).data if lca else None,
+        'distance': distance,
+    }
+
+
+@view_config(
+    route_name='glottolog.classification',
+    request_method='POST',
+    renderer='json')
+def classification(request):
+    """
+    Classification paths - from the top-level family down to the father - of many
+    languoids, passed as list `ids` of glottocodes in a JSON object.
+    """
+    payload = request.json_body
+    ids = payload.get('ids') if isinstance(payload, dict) else None
+    if not isinstance(ids, list):
+        request.response.status = 400
+        return {'error': 'Payload must be an object with a list of ids'}
+    ids = [gc for gc in OrderedDict(('{0}'.format(gc).strip(), 1) for gc in ids) if gc]
+    if len(ids) > MAX_CLASSIFICATIONS:
+        request.response.status = 400
+        return {'error': 'At most {0} classifications can be fetched at once'.format(
+            MAX_CLASSIFICATIONS)}
+
+    lineages = Languoid.get_lineages(ids)
+    schema = LanguoidSchema(many=True, only=['id', 'name', 'level'])
+    return {
+        'classifications': [
+            {'id': gc, 'classification': schema.dump(list(reversed(lineages[gc]))).data}
+            for gc in ids if gc in lineages],
+        'missing': [gc for gc in ids if gc not in lineages],
+    }
 
 
 @view_config(
@@ -292,8 +896,23 @@ def add_languoid(request):
         return {'error': errors}
 
     try:
-        DBSession.add(Languoid(**data))
+        father = father_pk(data.pop('father', None))
+    except ValueError as e:
+        request.response.status = 400
+        return {'error': '{}'.format(e)}
+
+    try:
+        languoid = Languoid(**data)
+        DBSession.add(languoid)
         DBSession.flush()
+        move_languoid(languoid.pk, father)
+        if father is None:
+            # a new top-level languoid is not moved, but is a new tree.
+            recreate_intervals([languoid.pk])
+            recreate_lineages([languoid.pk])
+            bump_generation(TREE)
+            bump_generation(GEO)
+        bump_generation(SEARCH)
     except exc.SQLAlchemyError as e:
         request.response.status = 400
         DBSession.rollback()
@@ -324,11 +943,36 @@ def put_languoid(request):
         request.response.status = 400
         return {'error': errors}
 
+    move = 'father' in data
+    try:
+        father = father_pk(data.pop('father', None))
+    except ValueError as e:
+        request.response.status = 400
+        return {'error': '{}'.format(e)}
+
+    old = {key: getattr(languoid, key) for key in data}
+    old_level = languoid.level
     try:
         for key, value in data.items():
             setattr(languoid, key, value)
         DBSession.flush()
-    except exc.SQLAlchemyError as e:
+        changed = set(key for key in data if getattr(languoid, key) != old[key])
+        update_level_counts(languoid.pk, old_level, languoid.level)
+        if move:
+            move_languoid(languoid.pk, father)
+        if 'name' in changed:
+            # the name is part of the lineage of all descendants.
+            rename_in_lineages(languoid.pk)
+        if changed & {'name', 'latitude', 'longitude'}:
+            # name and coordinates are part of the map layer of the languoid itself and
+            # of its ancestors, the name also orders the icons in the layer of the father
+            # - even if the languoid has no coordinates.
+            recreate_map_layers(
+                [languoid.pk] + [a.pk for a in languoid.get_ancestors()])
+        for generation, fields in GENERATION_FIELDS:
+            if changed & fields:
+                bump_generation(generation)
+    except (ValueError, exc.SQLAlchemyError) as e:
         request.response.status = 400
         DBSession.rollback()
         return {'error': "{}".format(e)}
@@ -336,6 +980,18 @@ def put_languoid(request):
     return LanguoidSchema().dump(languoid).data
 
 
+def father_pk(glottocode):
+    """
+    :return: pk of the active languoid with glottocode, or None if glottocode is None.
+    """
+    if glottocode is None:
+        return None
+    father = query_languoid(DBSession, glottocode)
+    if father is None:
+        raise ValueError('father {0} does not exist'.format(glottocode))
+    return father.pk
+
+
 @view_config(
     route_name='glottolog.delete_languoid',
     request_method='DELETE',
@@ -350,6 +1006,9 @@ def delete_languoid(request):
     try:
         languoid.active = False
         DBSession.flush()
+        bump_generation(SEARCH)
+        bump_generation(TREE)
+        bump_generation(GEO)
     except exc.SQLAlchemyError as e:
         request.response.status = 400
         DBSession.rollback()
@@ -375,16 +1034,24 @@ def add_descendant(request):
         request.response.status = 404
         return {'error': 'descendant specified in payload does not exist'}
 
+    moved = []
     try:
-        descendants = languoid.descendants
-        descendants.append(descendant)
-        setattr(languoid, 'descendants', descendants)
-        DBSession.flush()
+        # A languoid which is not yet part of the subtree is attached as child.
+        if not DBSession.query(Languoid.pk)\
+                .filter(Languoid.pk == descendant.pk)\
+                .filter(in_subtree(Languoid, languoid, proper=True))\
+                .first():
+            move_languoid(descendant.pk, languoid.pk)
+            moved.append(descendant.id)
+    except ValueError as e:
+        request.response.status = 400
+        DBSession.rollback()
+        return {'error': '{}'.format(e)}
     except exc.SQLAlchemyError as e:
         DBSession.rollback()
         return { 'error': '{}'.format(e) }
 
-    return LanguoidSchema().dump(languoid).data
+    return tree_summary(languoid, moved)
 
 
 @view_config(
@@ -405,13 +1072,72 @@ def add_child(request):
         return {'error': 'child specified in payload does not exist'}
 
     try:
-        children = languoid.children
-        children.append(child)
-        setattr(languoid, 'children', children)
-        DBSession.flush()
+        move_languoid(child.pk, languoid.pk)
+    except ValueError as e:
+        request.response.status = 400
+        DBSession.rollback()
+        return {'error': '{}'.format(e)}
     except exc.SQLAlchemyError as e:
         DBSession.rollback()
         return { 'error': '{}'.format(e) }
 
-    return LanguoidSchema().dump(languoid).data
+    return tree_summary(languoid, [child.id])
+
+
+@view_config(
+    route_name='glottolog.add_children',
+    request_method='POST',
+    renderer='json')
+def add_children(request):
+    """
+    Move many languoids - given as list of glottocodes `children` - below a languoid.
+    """
+    glottocode = request.matchdict['glottocode']
+    languoid = query_languoid(DBSession, glottocode)
+    if languoid is None:
+        request.response.status = 404
+        return {'error': 'Not a valid languoid ID'}
+
+    payload = request.json_body
+    glottocodes = payload.get('children') if isinstance(payload, dict) else None
+    if not isinstance(glottocodes, list):
+        request.response.status = 400
+        return {'error': 'Payload must be an object with a list of children'}
+    glottocodes = [gc for gc in OrderedDict(('{0}'.format(gc), 1) for gc in glottocodes)]
+    if len(glottocodes) > MAX_LANGUOIDS:
+        request.response.status = 400
+        return {'error': 'At most {0} languoids can be moved at once'.format(MAX_LANGUOIDS)}
+
+    children = dict(DBSession.query(Languoid.id, Languoid.pk)
+                    .filter(Languoid.id.in_(glottocodes))
+                    .filter(Language.active == True))
+    missing = [gc for gc in glottocodes if gc not in children]
+    if missing:
+        request.response.status = 404
+        return {'error': 'children specified in payload do not exist: {0}'.format(
+            ', '.join(missing))}
+
+    try:
+        move_languoids([children[gc] for gc in glottocodes], languoid.pk)
+    except ValueError as e:
+        request.response.status = 400
+        DBSession.rollback()
+        return {'error': '{}'.format(e)}
+    except exc.SQLAlchemyError as e:
+        DBSession.rollback()
+        return { 'error': '{}'.format(e) }
+
+    return tree_summary(languoid, glottocodes)
+
+
+def tree_summary(languoid, moved):
+    """
+    Lightweight response to tree edits, without the lists of children and descendants.
+    """
+    res = LanguoidSchema(only=[
+        'id', 'name', 'level',
+        'child_family_count', 'child_language_count', 'child_dialect_count',
+    ]).dump(languoid).data
+    res['moved'] = moved
+    return res
 # BLUEPRINT CODE END
@@ -1,22 +1,74 @@
 import pytest
+import sqlalchemy as sa
+
+
+def get_languoid(glottocode):
+    from clld.db.meta import DBSession
+    from glottolog3.models import Languoid
+
+    DBSession.expire_all()
+    return DBSession.query(Languoid).filter_by(id=glottocode).one()
+
+
+def get_closure(languoid):
+    """
+    :return: dict mapping the pks of the ancestors of a languoid - and its own - to depth.
+    """
+    from clld.db.meta import DBSession
+    from glottolog3.models import TreeClosureTable
+
+    return dict(DBSession.query(TreeClosureTable.parent_pk, TreeClosureTable.depth)
+                .filter(TreeClosureTable.child_pk == languoid.pk))
+
+
+def tree_state(glottocodes):
+    """
+    :return: dict mapping the glottocodes of languoids, their ancestors and descendants to \
+    the tree attributes and closure rows of the languoids.
+    """
+    from clld.db.meta import DBSession
+    from glottolog3.models import Languoid, in_subtree
+
+    res = {}
+    for glottocode in glottocodes:
+        languoid = get_languoid(glottocode)
+        nodes = DBSession.query(Languoid).filter(in_subtree(Languoid, languoid)).all()
+        for l in nodes + list(languoid.get_ancestors()):
+            res[l.id] = (
+                l.father_pk, l.family_pk,
+                l.child_family_count, l.child_language_count, l.child_dialect_count,
+                l.lineage, get_closure(l))
+    return res
+
 
 @pytest.mark.parametrize('path, match', [
     # search term requires a minimum of 3 characters
     ('/search?q=en', '[{"message": "Query must be at least 3 characters."}]'),
     # languages can be searched by iso (which counts as an identifier)
     ('/search?q=lzh', '[{"glottocode": "lite1248", "iso": "lzh", "name": "Literary Chinese", "matched_identifiers": ["lzh"], "level": "language"}]'),
+    # code identifiers are matched exactly, ahead of names
+    ('/search?q=ENG', '[{"glottocode": "stan1293", "iso": "eng", "name": "English", "matched_identifiers": ["eng"], "level": "language"}, '),
     # languages can be searched by glottocode
     ('/search?q=kumy1244', '[{"glottocode": "kumy1244", "iso": "kum", "name": "Kumyk", "matched_identifiers": [], "level": "language"}]'),
     # Multilingual set to false
     ('/search?q=anglai&multilingual=false', '[]'),
     # multilingual indentifier matching allows more results. The results are ordered by identifier similarity
     ('/search?q=anglai&multilingual=true', '[{"glottocode": "stan1293", "iso": "eng", "name": "English", "matched_identifiers": ["anglais", "Anglais moderne"], "level": "language"}, {"glottocode": "midd1317", "iso": "enm", "name": "Middle English", "matched_identifiers": ["anglais moyen (1100-1500)", "Moyen anglais"], "level": "language"}, {"glottocode": "tsha1245", "iso": "tsj", "name": "Tshangla", "matched_identifiers": ["Tshanglaish"], "level": "language"}]'),
+    # identifiers are matched regardless of case and diacritics
+    ('/search?q=%C3%85NGLAIS%20MODERNE', '[{"glottocode": "stan1293", "iso": "eng", "name": "English", "matched_identifiers": ["Anglais moderne"], "level": "language"}]'),
+    ('/search?q=KUMUKL%C3%A1R', '"glottocode": "kumy1244"'),
     # partial word matching set by default
     ('/search?q=klar', '[{"glottocode": "kumy1244", "iso": "kum", "name": "Kumyk", "matched_identifiers": ["Kumuklar"], "level": "language"}]'),
     # whole word matching removes partial-match results
     ('/search?q=klar&whole=true', '[]'),
     # whole word match successful
     ('/search?q=Literary%20Chinese&whole=true', '[{"glottocode": "lite1248", "iso": "lzh", "name": "Literary Chinese", "matched_identifiers": ["Literary Chinese"], "level": "language"}]'),
+    # fuzzy matching finds names within a small edit distance
+    ('/search?q=kumik', '[]'),
+    ('/search?q=kumik&fuzzy=true', '"glottocode": "kumy1244"'),
+    ('/search?q=tshangal&fuzzy=true', '"glottocode": "tsha1245"'),
+    # name completion
+    ('/search/suggest?q=literary%20chi', '"name": "Literary Chinese"'),
 ])
 
 def test_search_api(app, path, match):
@@ -25,6 +77,31 @@ def test_search_api(app, path, match):
     if match is not None:
         assert match in res
 
+def test_search_api_paging(app):
+    res = app.get('/search?q=anglai&limit=2', status=200)
+    assert len(res.json) == 2
+    assert 'rel="next"' in res.headers['Link']
+    res = app.get(res.headers['Link'].split('>')[0][1:], status=200)
+    assert [r['glottocode'] for r in res.json] == ['tsha1245']
+    assert 'Link' not in res.headers
+    app.get('/search?q=anglai&cursor=invalid', status=400)
+
+
+def test_search_api_batch(app):
+    terms = ['stan1293', {'q': 'Tshangal ', 'fuzzy': True}, 'en']
+    res = app.post_json('/search/batch', {'terms': terms, 'limit': 1}, status=200)
+    # results are returned with the terms as sent:
+    assert [r['q'] for r in res.json] == ['stan1293', 'Tshangal ', 'en']
+    assert [[m['glottocode'] for m in r['results']] for r in res.json] == \
+        [['stan1293'], ['tsha1245'], []]
+    res = app.post_json('/search/batch?stream=true', {'terms': terms}, status=200)
+    assert res.content_type == 'application/x-ndjson'
+    assert len(res.text.splitlines()) == 3
+    app.post_json('/search/batch', {'terms': 'stan1293'}, status=400)
+    app.post_json(
+        '/search/batch', {'terms': [{'q': 'tshangal', 'fuzzy': 'true'}]}, status=400)
+    app.post_json('/search/batch', {'terms': ['tshangal'], 'whole': 1}, status=400)
+
 @pytest.mark.parametrize('path, status, match', [
     # generic English
     ('/languoid/stan1293', 200, '"id": "stan1293", "name": "English", "level": "Language"'),
@@ -32,7 +109,253 @@ def test_search_api(app, path, match):
     ('/languoid/test1111', 404, '"error"'),
     # glottocode with improper format
     ('/languoid/test11111', 404, '"error"'),
+    # sparse fieldsets
+    ('/languoid/stan1293?fields=id,level', 200, '{"id": "stan1293", "level": "Language"}'),
+    ('/languoid/stan1293?fields=id,unknown', 400, '"error"'),
+    ('/languoid/test1111/descendants', 404, '"error"'),
 ])
 def test_languoid_get(app, path, status, match):
     res = app.get(path, {'status': status}, expect_errors=True)
     assert match in res
+
+
+def test_languoid_descendants(app):
+    res = app.get('/languoid/germ1287/descendants?limit=2', status=200)
+    assert len(res.json) == 2
+    names = [d['name'] for d in res.json]
+    res = app.get(res.headers['Link'].split('>')[0][1:], status=200)
+    assert names[1] <= res.json[0]['name']
+    app.get('/languoid/germ1287/descendants?cursor=invalid', status=400)
+
+
+def test_languoids_bulk(app):
+    res = app.get('/languoids?ids=stan1293,test1111,kumy1244&fields=id,name', status=200)
+    assert res.json == {
+        'languoids': [{'id': 'stan1293', 'name': 'English'}, {'id': 'kumy1244', 'name': 'Kumyk'}],
+        'missing': ['test1111'],
+    }
+    res = app.post_json('/languoids', {'ids': ['lite1248']}, status=200)
+    assert res.json['languoids'][0]['hid'] == 'lzh'
+    app.post_json('/languoids', ['lite1248'], status=400)
+
+
+def test_languoid_lca(app):
+    res = app.get('/languoid/stan1293/lca/stan1293', status=200)
+    assert res.json['lca']['id'] == 'stan1293' and res.json['distance'] == 0
+    res = app.get('/languoid/stan1293/lca/kumy1244', status=200)
+    assert res.json['lca'] is None and res.json['distance'] is None
+    app.get('/languoid/stan1293/lca/test1111', status=404)
+    res = app.post_json(
+        '/lca', {'pairs': [['stan1293', 'stan1295'], ['stan1295', 'stan1293']]}, status=200)
+    assert res.json[0]['lca'] == res.json[1]['lca']
+    assert res.json[0]['distance'] >= 2
+    app.post_json('/lca', {'pairs': [['stan1293']]}, status=400)
+
+
+def test_classification(app):
+    res = app.post_json('/classification', {'ids': ['stan1293', 'test1111']}, status=200)
+    assert res.json['missing'] == ['test1111']
+    path = res.json['classifications'][0]['classification']
+    assert path[0] == {'id': 'indo1319', 'name': 'Indo-European', 'level': 'LanguageFamily'}
+    assert 'germ1287' in [a['id'] for a in path]
+    app.post_json('/classification', ['stan1293'], status=400)
+
+
+def test_phyloxml(app):
+    res = app.get('/resource/languoid/id/germ1287.phylo.xml', status=200)
+    assert res.content_type == 'application/xml'
+    assert res.text.endswith('</phylogeny></phyloxml>')
+    assert '<desc>Indo-European &gt; ' in res.text
+
+
+def test_languoid_tree(app):
+    res = app.get('/languoid/stan1293/tree', status=200)
+    assert res.json[0]['id'] == 'indo1319'
+    etag = res.headers['ETag']
+    # all languoids of a family share the tree.
+    app.get('/languoid/indo1319/tree', headers={'If-None-Match': etag}, status=304)
+    app.get('/languoid/test1111/tree', status=404)
+
+
+def test_languoid_newick(app):
+    res = app.get('/languoid/germ1287/newick?depth=1', status=200)
+    assert res.text.endswith("'Germanic [germ1287]':1;")
+    assert 'stan1293' not in res.text
+    res = app.get('/languoid/germ1287/newick?level=language&format=nexus', status=200)
+    assert res.text.startswith('#NEXUS')
+    assert 'stan1293' in res.text
+    # all nodes but the root are languages:
+    assert res.text.count("':") - 1 == res.text.count("-l-':")
+    app.get('/languoid/germ1287/newick?depth=x', status=400)
+    app.get('/languoid/germ1287/newick?level=x', status=400)
+
+
+def test_language_tiles(app):
+    res = app.get('/languages/tiles/8/128/84', status=200)
+    features = {f['id']: f['properties'] for f in res.json['features']}
+    assert features['stan1293']['family']['id'] == 'indo1319'
+    assert 'icon' in features['stan1293']
+    # nearby languages are clustered at low zoom levels:
+    res = app.get('/languages/tiles/0/0/0', status=200)
+    assert any(f['properties'].get('cluster') for f in res.json['features'])
+    app.get(
+        '/languages/tiles/0/0/0', headers={'If-None-Match': res.headers['ETag']}, status=304)
+    res = app.get(
+        '/languages/tiles/0/0/0?layer=x',
+        headers={'If-None-Match': res.headers['ETag']},
+        status=200)
+    assert res.json['properties']['layer'] == 'x'
+    app.get('/languages/tiles/1/0/2', status=400)
+
+
+def test_languoids_bbox(app):
+    res = app.get('/languoids/bbox?bbox=-5,45,5,55', status=200)
+    assert 'stan1293' in [l['id'] for l in res.json]
+    assert all(-5 <= l['longitude'] <= 5 for l in res.json)
+    app.get('/languoids/bbox?bbox=-5,45,5', status=400)
+    app.get('/languoids/bbox?bbox=-5,45,5,95', status=400)
+
+
+def test_languoids_near(app):
+    res = app.get('/languoids/near?lon=-0.1&lat=51.5&k=3', status=200)
+    assert len(res.json) == 3
+    distances = [l['distance'] for l in res.json]
+    assert distances == sorted(distances)
+    app.get('/languoids/near?lon=-0.1', status=400)
+
+
+def test_map_layer(app):
+    from clld.db.meta import DBSession
+    from glottolog3.models import Languoid, MapLayer
+
+    layer_hash = DBSession.query(MapLayer.hash)\
+        .join(Languoid, Languoid.pk == MapLayer.languoid_pk)\
+        .filter(Languoid.id == 'germ1287')\
+        .scalar()
+    res = app.get('/languoid/germ1287/maplayer?v={0}'.format(layer_hash), status=200)
+    assert 'max-age=31536000' in res.headers['Cache-Control']
+    assert 'stan1293' in [f['id'] for f in res.json['features']]
+    res = app.get('/languoid/germ1287/maplayer', status=200)
+    assert res.headers['Cache-Control'] == 'no-cache'
+    app.get('/languoid/test1111/maplayer', status=404)
+
+
+def test_languoid_get_query_count(app):
+    from clld.db.meta import DBSession
+
+    statements = []
+
+    def count(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    # warm up, so connecting does not count.
+    app.get('/languoid/indo1319', status=200)
+    engine = DBSession.get_bind()
+    sa.event.listen(engine, 'before_cursor_execute', count)
+    try:
+        res = app.get('/languoid/indo1319', status=200)
+    finally:
+        sa.event.remove(engine, 'before_cursor_execute', count)
+    assert res.json['descendants']
+    # the document is read with one statement, independent of the size of the family.
+    assert len(statements) == 1
+
+
+def test_languoid_move(app):
+    from clld.db.meta import DBSession
+    from glottolog3.models import Languoid, LanguoidLevel, in_subtree
+
+    def size(l):
+        """
+        :return: number of families, languages and dialects in the subtree of l.
+        """
+        return [
+            l.child_family_count + (l.level == LanguoidLevel.family),
+            l.child_language_count + (l.level == LanguoidLevel.language),
+            l.child_dialect_count + (l.level == LanguoidLevel.dialect)]
+
+    glottocodes = ['kumy1244', 'lite1248']
+    before = tree_state(glottocodes + ['germ1287'])
+    fathers = {gc: get_languoid(gc).father.id for gc in glottocodes}
+    sizes = {gc: size(get_languoid(gc)) for gc in glottocodes + ['germ1287']}
+    sizes.update({gc: size(get_languoid(gc)) for gc in fathers.values()})
+    try:
+        res = app.post_json(
+            '/languoid/germ1287/children', {'children': glottocodes}, status=200)
+        assert res.json['moved'] == glottocodes
+
+        germ = get_languoid('germ1287')
+        germ_closure = get_closure(germ)
+        assert size(germ) == [
+            sum(n) for n in zip(*[sizes['germ1287']] + [sizes[gc] for gc in glottocodes])]
+        for gc, father in fathers.items():
+            assert size(get_languoid(father)) == [
+                n - m for n, m in zip(sizes[father], sizes[gc])]
+
+            moved = get_languoid(gc)
+            assert moved.father_pk == germ.pk
+            assert moved.lineage == germ.lineage + [{'id': germ.id, 'name': germ.name}]
+            subtree = DBSession.query(Languoid).filter(in_subtree(Languoid, moved)).all()
+            assert len(subtree) == sum(sizes[gc])
+            for l in subtree:
+                assert l.family_pk == germ.family_pk
+                assert germ.lft < moved.lft <= l.lft < l.rgt <= moved.rgt < germ.rgt
+                path = l.lineage + [{'id': l.id, 'name': l.name}]
+                assert path[:len(moved.lineage) + 1] == \
+                    moved.lineage + [{'id': moved.id, 'name': moved.name}]
+                # the closure rows within the subtree are kept, the rows for the old
+                # ancestors are replaced with rows for the new ones.
+                closure = get_closure(l)
+                depth = closure[moved.pk]
+                assert {pk: d - depth - 1 for pk, d in closure.items() if d > depth} == \
+                    germ_closure
+
+        # languoids cannot be moved below their descendants:
+        app.post_json('/languoid/stan1293/child', {'child': 'germ1287'}, status=400)
+        app.post_json(
+            '/languoid/stan1293/children', {'children': ['kumy1244', 'germ1287']},
+            status=400)
+        assert get_languoid('germ1287').father_pk == germ.father_pk
+    finally:
+        for gc, father in fathers.items():
+            app.post_json('/languoid/{0}/child'.format(father), {'child': gc}, status=200)
+    assert tree_state(glottocodes + ['germ1287']) == before
+
+
+def test_languoid_put_tree(app):
+    from clld.db.meta import DBSession
+    from glottolog3.models import Languoid, in_subtree
+
+    def in_tree(glottocode, root):
+        languoid = get_languoid(glottocode)
+        return DBSession.query(Languoid)\
+            .filter(Languoid.pk == languoid.pk)\
+            .filter(in_subtree(Languoid, get_languoid(root), proper=True))\
+            .count() == 1
+
+    def classification(glottocode):
+        return [
+            (a['id'], a['name'])
+            for a in get_languoid(glottocode).__json__(None)['classification']]
+
+    before = tree_state(['stan1293', 'kumy1244'])
+    father = get_languoid('kumy1244').father.id
+    name = get_languoid('germ1287').name
+    try:
+        app.put_json('/languoid/kumy1244', {'father': 'germ1287'}, status=200)
+        assert [a.id for a in get_languoid('kumy1244').get_ancestors()] == \
+            ['germ1287', 'indo1319']
+        assert in_tree('kumy1244', 'germ1287') and not in_tree('kumy1244', father)
+        assert classification('kumy1244') == \
+            [('indo1319', 'Indo-European'), ('germ1287', name)]
+
+        # the name of a languoid is part of the lineage of its descendants:
+        app.put_json('/languoid/germ1287', {'name': 'Germanic languages'}, status=200)
+        for glottocode in ['kumy1244', 'stan1293']:
+            assert ('germ1287', 'Germanic languages') in classification(glottocode)
+
+        app.put_json('/languoid/kumy1244', {'father': 'kumy1244'}, status=400)
+    finally:
+        app.put_json('/languoid/germ1287', {'name': name}, status=200)
+        app.put_json('/languoid/kumy1244', {'father': father}, status=200)
+    assert tree_state(['stan1293', 'kumy1244']) == before
@@ -1,10 +1,19 @@
+# coding: utf8
 from __future__ import unicode_literals
 
 import pytest
 import colander
 
-from glottolog3.models import Doctype
-from glottolog3.util import normalize_language_explanation, ModelInstance
+from glottolog3.models import Doctype, Languoid, LanguoidLevel, LanguoidStatus
+from glottolog3.cache import LRUCache, Generation, invalidate
+from glottolog3.search import PrefixIndex, CodeIndex, normalize
+from glottolog3.tree import TreeSnapshot, LCAIndex, FamilyTree, pack, newick
+from glottolog3.geo import (
+    TileGrid, GeoLanguage, Cluster, pixel, SpatialIndex, GeoLanguoid,
+)
+from glottolog3.util import (
+    normalize_language_explanation, ModelInstance, encode_cursor, decode_cursor,
+)
 
 
 def test_normalize_language_explanation():
@@ -36,3 +45,218 @@ def test_ModelInstance():
     assert isinstance(mi.deserialize(None, 'existing'), Model)
     with pytest.raises(colander.Invalid):
         mi.deserialize(None, 'missing')
+
+
+def test_Languoid_json():
+    languoid = Languoid(
+        id='stan1293', name='English', level=LanguoidLevel.language, lft=1, rgt=2,
+        lineage=[])
+    # the columns used for tree queries are not part of the JSON.
+    assert set(languoid.__json__(None, core=True)) == {
+        'pk', 'jsondata', 'id', 'name', 'description', 'markup_description',
+        'latitude', 'longitude', 'hid', 'father_pk', 'family_pk', 'level', 'status',
+        'bookkeeping', 'newick', 'child_family_count', 'child_language_count',
+        'child_dialect_count'}
+
+
+def test_cursor():
+    cursor = encode_cursor([0.5, 'Tshangla', 'tsha1245'])
+    assert decode_cursor(cursor, 3) == [0.5, 'Tshangla', 'tsha1245']
+    with pytest.raises(ValueError):
+        decode_cursor(cursor, 2)
+    with pytest.raises(ValueError):
+        decode_cursor('not a cursor', 3)
+
+
+def test_LRUCache():
+    now = [0]
+    cache = LRUCache(maxsize=2, ttl=10, clock=lambda: now[0])
+    cache.set('a', 1, 1)
+    cache.set('b', 2, 1)
+    assert cache.get('a', 1) == 1
+    cache.set('c', 3, 1)
+    # 'b' was least recently used:
+    assert cache.get('b', 1) is None
+    assert cache.get('a', 1) == 1
+    now[0] = 11
+    assert cache.get('a', 1) is None
+    cache.set('a', 1, 1)
+    # a new generation invalidates all entries:
+    assert cache.get('a', 2) is None
+    assert cache.stats()['hits'] == 2
+    assert cache.stats()['misses'] == 3
+    assert cache.stats()['evictions'] == 4
+
+
+def test_Generation(monkeypatch):
+    generations = {'search': 1}
+    monkeypatch.setattr(
+        'glottolog3.cache.get_generation',
+        lambda name, session=None: generations[name])
+    generation = Generation('search', clock=lambda: 0)
+    assert generation.get() == 1
+    generations['search'] = 2
+    # the generation is checked at most every check_interval seconds, ...
+    assert generation.get() == 1
+    # ... unless it was bumped by this process:
+    invalidate('tree')
+    assert generation.get() == 1
+    invalidate('search')
+    assert generation.get() == 2
+
+
+def test_normalize():
+    assert normalize(' Ḱümükça ') == 'kumukca'
+    assert normalize('Literary  Chinese') == 'literary chinese'
+    assert normalize('文言') == 'wen yan'
+
+
+def test_PrefixIndex():
+    index = PrefixIndex([
+        ('Kumyk', 'kumy1244'), ('Kumuklar', 'kumy1244'), ('Kümük', 'kumy1244'),
+        ('English', 'stan1293')])
+    assert len(index) == 4
+    assert index.complete('kum', limit=2) == [
+        ('Kümük', 'kumy1244'), ('Kumuklar', 'kumy1244')]
+    assert index.complete('KÜMY ') == [('Kumyk', 'kumy1244')]
+    assert index.complete('x') == []
+    assert index.complete('') == []
+
+
+def test_CodeIndex():
+    index = CodeIndex([
+        ('kum', 'kumy1244', 'Kumyk', 'kum', 'language'),
+        ('kum', 'kumy1244', 'Kumyk', 'kum', 'language'),
+        ('eng', 'stan1293', 'English', 'eng', 'language'),
+        ('eng', 'kumy1244', 'Kumyk', 'kum', 'language')])
+    assert len(index) == 2
+    assert [m.id for m in index.lookup(' ENG')] == ['stan1293', 'kumy1244']
+    assert index.lookup('kum')[0].identifiers == ['kum']
+    assert index.lookup('xyz') == []
+
+
+def test_TreeSnapshot():
+    family, language = LanguoidLevel.family, LanguoidLevel.language
+    dialect = LanguoidLevel.dialect
+    snapshot = TreeSnapshot(pack(3, [
+        (1, None, 'indo1319', 'Indo-European', family, None, 1, 8),
+        (4, 1, 'germ1287', 'Germanic', family, None, 2, 7),
+        (8, 4, 'stan1293', 'English', language, LanguoidStatus.safe, 3, 6),
+        (12, 8, 'scot1234', 'Scots Énglish', dialect, None, 4, 5),
+        (2, None, 'kumy1244', 'Kumyk', language, LanguoidStatus.vulnerable, 1, 2),
+    ]))
+    assert snapshot.generation == 3 and len(snapshot) == 5
+    i = snapshot.index(12)
+    assert snapshot.node(i) == (12, 'scot1234', 'Scots Énglish', dialect, None)
+    assert [snapshot.id(j) for j in snapshot.ancestors(i)] == \
+        ['stan1293', 'germ1287', 'indo1319']
+    assert [snapshot.pk(j) for j in snapshot.descendants(snapshot.index(1))] == [4, 8, 12]
+    assert list(snapshot.children(snapshot.index(4))) == [snapshot.index(8)]
+    assert snapshot.ancestors(snapshot.index(2)) == []
+    assert snapshot.status(snapshot.index(2)) == LanguoidStatus.vulnerable
+    assert snapshot.index(3) is None
+    with pytest.raises(ValueError):
+        TreeSnapshot(b'x' * 64)
+
+
+def test_LCAIndex():
+    index = LCAIndex([
+        (8, 4, 'stan1293', 'English', LanguoidLevel.language, True),
+        (1, None, 'indo1319', 'Indo-European', LanguoidLevel.family, True),
+        (4, 1, 'germ1287', 'Germanic', LanguoidLevel.family, True),
+        (10, 4, 'stan1295', 'German', LanguoidLevel.language, True),
+        (12, 8, 'scot1234', 'Scots', LanguoidLevel.dialect, True),
+        (2, None, 'kumy1244', 'Kumyk', LanguoidLevel.language, True),
+        (3, 1, 'xxxx1234', 'Inactive', LanguoidLevel.language, False),
+    ])
+    assert len(index) == 6 and 'xxxx1234' not in index
+    lca, distance = index.relation('scot1234', 'stan1295')
+    assert lca.id == 'germ1287' and distance == 3
+    germanic = index.relation('germ1287', 'germ1287').lca
+    assert index.relation('germ1287', 'scot1234') == (germanic, 2)
+    assert index.relation('stan1293', 'kumy1244') == (None, None)
+    with pytest.raises(KeyError):
+        index.relation('stan1293', 'xxxx1234')
+
+
+def test_FamilyTree():
+    tree = FamilyTree([
+        (None, 1, 'indo1319', 'Indo-European', None, 'family', 'safe', 3),
+        (1, 4, 'germ1287', 'Germanic', None, 'family', 'safe', 2),
+        (4, 10, 'stan1295', 'German', 'deu', 'language', 'safe', 0),
+        (4, 8, 'stan1293', 'English', 'eng', 'language', 'safe', 0),
+        (1, 5, 'roma1334', 'Romance', None, 'family', 'safe', 1),
+        (99, 12, 'orph1234', 'Orphan', None, 'dialect', None, 0),
+    ])
+    assert tree.nodes[0]['label'] == 'Indo-European (3)'
+    # siblings are ordered by name, not by the order of the items.
+    assert [n['id'] for n in tree.nodes[0]['children'][0]['children']] == \
+        ['stan1293', 'stan1295']
+    nodes = tree.overlay({8: {'child': True}})
+    germanic, romance = nodes[0]['children']
+    assert germanic['children'][0]['child'] is True
+    # nodes without overlaid descendants are shared, the cached nodes are unchanged.
+    assert romance is tree.nodes[0]['children'][1]
+    assert germanic['children'][1] is tree.nodes[0]['children'][0]['children'][1]
+    assert 'child' not in tree.nodes[0]['children'][0]['children'][0]
+    assert b'"orph1234"' not in tree.json()
+
+
+def test_newick():
+    items = [
+        (1, None, 'indo1319', 'Indo-European', None, LanguoidLevel.family),
+        (4, 1, 'germ1287', 'Germanic', None, LanguoidLevel.family),
+        (8, 4, 'stan1293', "English (Standard)", 'eng', LanguoidLevel.language),
+        (9, 8, 'scot1234', "Scots, Ulster", None, LanguoidLevel.dialect),
+        (5, 1, 'roma1334', 'Romance', None, LanguoidLevel.family),
+        (12, 99, 'orph1234', 'Orphan', None, LanguoidLevel.dialect),
+    ]
+    assert newick(items) == \
+        "((('Scots/ Ulster [scot1234]':1)" \
+        "'English {Standard} [stan1293][eng]-l-':1)'Germanic [germ1287]':1," \
+        "'Romance [roma1334]':1)'Indo-European [indo1319]':1;"
+    assert newick(items, depth=1) == \
+        "('Germanic [germ1287]':1,'Romance [roma1334]':1)'Indo-European [indo1319]':1;"
+    # nodes of other levels are contracted:
+    assert newick(items, levels=[LanguoidLevel.language]) == \
+        "('English {Standard} [stan1293][eng]-l-':2)'Indo-European [indo1319]':1;"
+
+
+def test_TileGrid():
+    grid = TileGrid([
+        GeoLanguage(1, 'stan1293', 'English', 1.0, 52.0, 10, 'indo1319', 'Indo-European'),
+        GeoLanguage(
+            2, 'midd1317', 'Middle English', 2.0, 52.5, 10, 'indo1319', 'Indo-European'),
+        GeoLanguage(
+            3, 'lite1248', 'Literary Chinese', 110.0, 35.0, 20, 'sino1245', 'Sino-Tibetan'),
+    ])
+    assert len(grid) == 3
+    # at zoom level 0, English and Middle English are clustered:
+    cluster, chinese = sorted(grid.tile(0, 0, 0), key=lambda f: f.longitude)
+    assert cluster == Cluster(2, 1.5, 52.25) and chinese.id == 'lite1248'
+    # x wraps around:
+    x, y = pixel(1.0, 52.0, 8)
+    assert [f.id for f in grid.tile(8, x, y)] == ['stan1293']
+    assert grid.tile(8, x + 256, y) == grid.tile(8, x, y)
+    with pytest.raises(ValueError):
+        grid.tile(1, 0, 2)
+
+
+def test_SpatialIndex():
+    language, dialect = LanguoidLevel.language, LanguoidLevel.dialect
+    index = SpatialIndex([
+        GeoLanguoid(1, 'stan1293', 'English', 0.0, 52.0, language),
+        GeoLanguoid(2, 'scot1234', 'Scots', -4.0, 56.0, dialect),
+        GeoLanguoid(3, 'stan1290', 'French', 2.0, 48.0, language),
+        GeoLanguoid(4, 'fiji1243', 'Fijian', 178.0, -18.0, language),
+        GeoLanguoid(5, 'samo1305', 'Samoan', -172.0, -13.5, language),
+    ])
+    assert [l.id for l in index.bbox(-5, 45, 5, 57)] == ['scot1234', 'stan1293', 'stan1290']
+    assert [l.id for l in index.bbox(-5, 45, 5, 57, levels=[dialect])] == ['scot1234']
+    # boxes and neighbours across the antimeridian:
+    assert [l.id for l in index.bbox(170, -20, -170, 0)] == ['fiji1243', 'samo1305']
+    (fijian, distance), = index.near(-179.5, -17.0, 1)
+    assert fijian.id == 'fiji1243' and 250 < distance < 350
+    assert [l.id for l, _ in index.near(0.0, 52.0, 2, levels=[language])] == \
+        ['stan1293', 'stan1290']
+    assert len(index.near(0.0, 0.0, 10)) == 5